@@ -0,0 +1,207 @@
+"""
+Paridade da agregação por técnico com o laço original do upload_file
+(dois iterrows sobre df_cleaned), sobre as exportações reais em uploads/
+"""
+import glob
+import os
+import re
+import tempfile
+import unittest
+from collections import Counter
+
+import pandas as pd
+
+from benchmarks.common import load_app
+
+# Auxiliares escritos com erro que a comparação aproximada (distância de edição)
+# associa ao técnico certo; o laço original os contava como técnicos à parte
+FUZZY_MATCHES = {'wandersons': 'wanderson'}
+# Aproximações com mais de um técnico possível ("marcos" é o primeiro nome de dois):
+# só pelo nome vão para revisão e continuam sem resolução, como no laço original
+AMBIGUOUS_MATCHES = {'marcosv'}
+# ...mas no upload o cadastro aprende o login (Usuário / Finalizado Por) de cada
+# responsável, e o auxiliar escrito como login é creditado ao técnico dono dele
+LOGIN_MATCHES = {'marcosv': 'venicius'}
+
+UPLOADS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', '*.xlsx')))
+
+def get_first_name(full_name):
+    if not isinstance(full_name, str):
+        return ""
+    return full_name.split()[0].lower().strip() if full_name.split() else ""
+
+def get_all_name_parts(full_name):
+    if not isinstance(full_name, str):
+        return []
+    return [part.lower().strip() for part in full_name.split()]
+
+def normalize_technician_name(name):
+    if not isinstance(name, str):
+        return ""
+    return name.strip().lower()
+
+def extract_first_names(technician_str):
+    if not isinstance(technician_str, str):
+        return []
+    normalized = re.sub(r'[;/|]+', ',', technician_str)
+    names = []
+    for tech in normalized.split(','):
+        tech = tech.strip()
+        if tech:
+            first_name = tech.split()[0] if tech.split() else ""
+            if first_name:
+                names.append(normalize_technician_name(first_name))
+    return list(dict.fromkeys(names))
+
+def loop_summary(df_cleaned, aux_aliases=None):
+    """
+    O cálculo do upload_file antes da versão colunar. aux_aliases (grafia do
+    auxiliar -> parte do nome) simula as correspondências aproximadas; sem ele,
+    o laço é o original sem alterações
+    """
+    aux_aliases = aux_aliases or {}
+    name_mapping = {}
+    for index, row in df_cleaned.iterrows():
+        if pd.notna(row['Responsável']):
+            full_name = normalize_technician_name(str(row['Responsável']))
+            for part in get_all_name_parts(full_name):
+                name_mapping[part] = full_name
+
+    technician_data = {}
+    processed_techs = set()
+    for index, row in df_cleaned.iterrows():
+        motivo = row['Motivo'] if pd.notna(row['Motivo']) else "Não especificado"
+        processed_techs.clear()
+
+        if pd.notna(row['Responsável']):
+            tech = normalize_technician_name(str(row['Responsável']))
+            if tech and tech not in processed_techs:
+                if tech not in technician_data:
+                    technician_data[tech] = {"Técnico": tech, "Quantidade de OS": 0, "Valor Total": 0,
+                                             "Motivos": Counter(), "Contratos": {}}
+                technician_data[tech]["Quantidade de OS"] += 1
+                technician_data[tech]["Valor Total"] += 3
+                technician_data[tech]["Motivos"][motivo] += 1
+                processed_techs.add(tech)
+                if pd.notna(row['ID Contrato']):
+                    technician_data[tech]["Contratos"].setdefault(motivo, []).append(str(row['ID Contrato']))
+
+        if pd.notna(row['Técnico(s) auxiliar(s)']):
+            for aux_tech in extract_first_names(str(row['Técnico(s) auxiliar(s)'])):
+                matched_full_name = name_mapping.get(aux_aliases.get(aux_tech, aux_tech))
+                if matched_full_name and matched_full_name not in processed_techs:
+                    tech = matched_full_name
+                elif aux_tech not in processed_techs:
+                    tech = aux_tech
+
+                if tech not in processed_techs:
+                    if tech not in technician_data:
+                        technician_data[tech] = {"Técnico": tech, "Quantidade de OS": 0, "Valor Total": 0,
+                                                 "Motivos": Counter(), "Contratos": {}}
+                    technician_data[tech]["Quantidade de OS"] += 1
+                    technician_data[tech]["Valor Total"] += 3
+                    technician_data[tech]["Motivos"][motivo] += 1
+                    processed_techs.add(tech)
+                    if pd.notna(row['ID Contrato']):
+                        technician_data[tech]["Contratos"].setdefault(motivo, []).append(str(row['ID Contrato']))
+
+    summary_data = []
+    for tech_info in technician_data.values():
+        total_os = tech_info["Quantidade de OS"]
+        motivos_list = [
+            {
+                "Motivo": motivo,
+                "Quantidade": quantidade,
+                "Porcentagem": round((quantidade / total_os) * 100, 1),
+                "Contratos": tech_info["Contratos"].get(motivo, [])
+            }
+            for motivo, quantidade in tech_info["Motivos"].items()
+        ]
+        summary_data.append({
+            "Técnico": tech_info["Técnico"].title(),
+            "Quantidade de OS": total_os,
+            "Valor Total": tech_info["Valor Total"],
+            "Motivos": sorted(motivos_list, key=lambda x: x["Quantidade"], reverse=True)
+        })
+    summary_data.sort(key=lambda x: x["Quantidade de OS"], reverse=True)
+    return summary_data
+
+def without_values(summary_data):
+    """
+    Tira a lista "Valores" de cada motivo, que o laço original não tinha
+    """
+    return [
+        dict(tech, Motivos=[{k: v for k, v in motivo.items() if k != 'Valores'} for motivo in tech['Motivos']])
+        for tech in summary_data
+    ]
+
+class AggregationParityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app_module = load_app()
+
+    def read_os(self, path):
+        df = pd.concat(self.app_module.iter_os_batches(path), ignore_index=True)
+        return df[~df['Motivo'].isin(self.app_module.EXCLUDED_MOTIVOS)]
+
+    def summarize(self, df_cleaned):
+        """
+        Agrega pelo caminho do upload (summarize_os) num banco novo, com as regras
+        iniciais e sem técnicos cadastrados por outras planilhas
+        """
+        app_module = self.app_module
+        app_module.DATABASE = os.path.join(tempfile.mkdtemp(), 'reports.db')
+        app_module.init_db()
+        # O índice em memória acompanha o banco anterior
+        app_module.technician_index.clear()
+        app_module.technician_index_version = 0
+        with app_module.app.app_context():
+            job_id = app_module.create_upload_job('parity.xlsx', 'parity')
+            rule_set_version = app_module.get_active_rule_set_version(app_module.get_db())
+            summary_data, _ = app_module.summarize_os(job_id, df_cleaned, rule_set_version)
+        return summary_data
+
+    def test_matches_original_loop(self):
+        """
+        Igual ao laço original, exceto pelos auxiliares com erro de digitação ou
+        escritos como login, que passam a ser creditados ao técnico certo
+        """
+        self.assertTrue(UPLOADS, 'nenhuma planilha em uploads/')
+        for path in UPLOADS:
+            with self.subTest(arquivo=os.path.basename(path)):
+                df_cleaned = self.read_os(path)
+                self.assertEqual(without_values(self.summarize(df_cleaned)),
+                                 loop_summary(df_cleaned, {**FUZZY_MATCHES, **LOGIN_MATCHES}))
+
+    def test_fuzzy_matches_are_reported(self):
+        for path in UPLOADS:
+            with self.subTest(arquivo=os.path.basename(path)):
+                df_cleaned = self.read_os(path)
+                _, review = self.app_module.build_assignments(df_cleaned)
+                present = ' '.join(df_cleaned['Técnico(s) auxiliar(s)'].dropna().astype(str).str.lower())
+                self.assertEqual({item['auxiliar'] for item in review if 'tecnico' in item},
+                                 {alias for alias in FUZZY_MATCHES if alias in present})
+                self.assertEqual({item['auxiliar'] for item in review if 'candidatos' in item},
+                                 {alias for alias in AMBIGUOUS_MATCHES if alias in present})
+
+    def test_technician_credited_once_per_os(self):
+        """
+        Mudança intencional (AGGREGATION_VERSION 3): o responsável citado também
+        como auxiliar recebe um crédito só; o laço original criava um técnico à
+        parte com o primeiro nome
+        """
+        df_cleaned = pd.DataFrame({
+            'ID': [1, 2],
+            'ID Contrato': [10, 20],
+            'Motivo': ['Instalação', 'Instalação'],
+            'Responsável': ['Evandro Sousa', 'Evandro Sousa'],
+            'Técnico(s) auxiliar(s)': ['Evandro', None],
+        })
+        summary_data = self.summarize(df_cleaned)
+        self.assertEqual([(tech['Técnico'], tech['Quantidade de OS'], tech['Valor Total']) for tech in summary_data],
+                         [('Evandro Sousa', 2, 6.0)])
+        self.assertEqual([(tech['Técnico'], tech['Quantidade de OS']) for tech in loop_summary(df_cleaned)],
+                         [('Evandro Sousa', 2), ('Evandro', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
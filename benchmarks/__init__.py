@@ -0,0 +1,6 @@
+"""
+Benchmarks do pipeline de comissão (ver16-Claude.py).
+
+Executar a partir da raiz do repositório, por exemplo:
+    python -m benchmarks.bench_templates
+"""
@@ -0,0 +1,153 @@
+"""
+Mede cada etapa do pipeline de upload (leitura da planilha, agregação,
+gravação no SQLite e renderização da página) sobre planilhas sintéticas de
+vários tamanhos, com tempo e pico de memória (tracemalloc) por etapa.
+
+    python -m benchmarks.bench_pipeline --sizes 1000,10000,100000
+    python -m benchmarks.bench_pipeline --save baseline.json
+    python -m benchmarks.bench_pipeline --compare baseline.json
+    python -m benchmarks.bench_pipeline --sizes 500000 --no-memory
+
+As planilhas geradas ficam em cache no diretório de --data-dir.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+from flask import render_template
+
+from benchmarks.common import load_app
+from benchmarks.generate_workbook import GENERATOR_VERSION, generate_workbook
+
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]
+STAGES = ['ingestao', 'agregacao', 'persistencia', 'renderizacao']
+
+def workbook_for(size, data_dir):
+    """
+    Devolve o caminho da planilha sintética com `size` OS, gerando-a se preciso
+    """
+    path = os.path.join(data_dir, f'ordens-{size}-v{GENERATOR_VERSION}.xlsx')
+    if not os.path.exists(path):
+        generate_workbook(path, size)
+    return path
+
+def measure(func, memory=True):
+    """
+    Executa func e retorna (resultado, segundos, pico de memória em MB). O
+    tracemalloc deixa o parse do openpyxl várias vezes mais lento, então o
+    pico é medido numa segunda execução, separada da cronometrada
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def run_size(app_module, path, memory=True):
+    """
+    Roda o pipeline completo sobre uma planilha e devolve {etapa: {segundos, memoria_mb}}
+    """
+    results = {}
+    
+    conn = app_module.connect_db()
+    exclusions = app_module.load_motivo_exclusions(conn)
+    conn.close()
+    
+    def ingest():
+        batches = [app_module.drop_excluded_motivos(batch, exclusions)
+                   for batch in app_module.iter_os_batches(path)]
+        return pd.concat(batches, ignore_index=True)
+    
+    df_cleaned, seconds, peak = measure(ingest, memory)
+    results['ingestao'] = dict(segundos=seconds, memoria_mb=peak)
+    
+    # O mesmo caminho do upload: cadastro de técnicos, regras de comissão do banco e totais
+    with app_module.app.app_context():
+        conn = app_module.get_db()
+        job_id = app_module.create_upload_job(os.path.basename(path), 'bench')
+        rule_set_version = app_module.get_active_rule_set_version(conn)
+        (summary_data, _), seconds, peak = measure(
+            lambda: app_module.summarize_os(job_id, df_cleaned, rule_set_version), memory)
+    results['agregacao'] = dict(segundos=seconds, memoria_mb=peak)
+    
+    def persist():
+        conn = app_module.connect_db()
+        c = conn.cursor()
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        c.execute('INSERT INTO reports (date, updated_date, filename, data) VALUES (?, ?, ?, ?)',
+                  (now, now, os.path.basename(path), '[]'))
+        report_id = c.lastrowid
+        app_module.insert_summary_rows(c, report_id, summary_data)
+        app_module.rebuild_chart_aggregates(c, report_id)
+        conn.commit()
+        conn.close()
+    
+    _, seconds, peak = measure(persist, memory)
+    results['persistencia'] = dict(segundos=seconds, memoria_mb=peak)
+    
+    with app_module.app.test_request_context('/upload'):
+        _, seconds, peak = measure(lambda: render_template(
+            'index.html',
+            summary_data=app_module.summary_for_page(summary_data),
+            filename=os.path.basename(path),
+            staging_token='bench',
+            contracts_url='/staged/bench/contracts'), memory)
+    results['renderizacao'] = dict(segundos=seconds, memoria_mb=peak)
+    return results
+
+def print_results(results, baseline=None):
+    print(f"{'linhas':>8}  {'etapa':<14}{'tempo (s)':>11}{'pico (MB)':>11}{'vs base':>10}")
+    for size, stages in results.items():
+        for stage in STAGES:
+            entry = stages[stage]
+            delta = ''
+            base = (baseline or {}).get(size, {}).get(stage)
+            if base and base['segundos']:
+                delta = f"{entry['segundos'] / base['segundos']:.2f}x"
+            peak = '-' if entry['memoria_mb'] is None else f"{entry['memoria_mb']:.1f}"
+            print(f"{size:>8}  {stage:<14}{entry['segundos']:>11.3f}{peak:>11}{delta:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='quantidades de OS separadas por vírgula')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'nextall-bench'),
+                        help='onde guardar as planilhas sintéticas')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='não mede o pico de memória (evita rodar cada etapa duas vezes)')
+    parser.add_argument('--save', help='grava os resultados em JSON para comparar depois')
+    parser.add_argument('--compare', help='JSON salvo com --save para comparar')
+    args = parser.parse_args()
+    
+    os.makedirs(args.data_dir, exist_ok=True)
+    app_module = load_app()
+    app_module.DATABASE = os.path.join(tempfile.mkdtemp(), 'reports.db')
+    app_module.init_db()
+    app_module.compile_templates()
+    
+    results = {}
+    for size in (int(s) for s in args.sizes.split(',')):
+        results[str(size)] = run_size(app_module, workbook_for(size, args.data_dir), not args.no_memory)
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Mede leituras concorrentes (gráfico JSON e lista de contratos) enquanto uma
+thread remove e restaura OS sem parar, comparando a configuração antiga do
+SQLite (journal padrão, sem pragmas) com a camada de conexão atual (WAL,
+synchronous=NORMAL, busy_timeout, cache_size, foreign_keys).
+
+    python -m benchmarks.bench_sqlite
+"""
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.common import load_app, make_summary_data
+
+READERS = 4
+DURATION_SECONDS = 5
+
+def legacy_connect(app_module):
+    """
+    Conexão como era antes: sqlite3.connect puro, journal em modo DELETE
+    """
+    def connect_db():
+        conn = sqlite3.connect(app_module.DATABASE)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = DELETE')
+        return conn
+    return connect_db
+
+def prepare_database(app_module, path):
+    """
+    Cria o banco com um relatório sintético salvo e devolve (report_id, técnico, motivo, contrato)
+    """
+    app_module.DATABASE = path
+    app_module.init_db()
+    summary_data = make_summary_data()
+    conn = app_module.connect_db()
+    c = conn.cursor()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    c.execute('INSERT INTO reports (date, updated_date, filename, data) VALUES (?, ?, ?, ?)',
+              (now, now, 'bench.xlsx', '[]'))
+    report_id = c.lastrowid
+    app_module.insert_summary_rows(c, report_id, summary_data)
+    app_module.rebuild_chart_aggregates(c, report_id)
+    conn.commit()
+    conn.close()
+    tech = summary_data[0]
+    motivo = tech["Motivos"][0]
+    return report_id, tech["Técnico"], motivo["Motivo"], motivo["Contratos"][0]
+
+def run(app_module, report_id, technician, motivo, contract_id):
+    """
+    Executa leitores e um escritor em paralelo e retorna as latências de leitura (ms) e o total de escritas
+    """
+    stop = threading.Event()
+    latencies = []
+    writes = [0]
+    lock = threading.Lock()
+    
+    def reader(index):
+        client = app_module.app.test_client()
+        urls = [
+            f'/report/{report_id}/chart.json',
+            f'/report/{report_id}/contracts?technician={technician}&motivo={motivo}',
+        ]
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            response = client.get(urls[len(local) % 2])
+            assert response.status_code == 200, response.status_code
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+    
+    def writer():
+        client = app_module.app.test_client()
+        form = dict(report_id=report_id, contract_id=contract_id, technician=technician, motivo=motivo)
+        while not stop.is_set():
+            client.post('/remove_os', data=dict(form, removal_reason='benchmark'))
+            client.post('/restore_os', data=form)
+            writes[0] += 2
+    
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(READERS)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION_SECONDS)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, writes[0]
+
+def main():
+    results = {}
+    for label in ('antes', 'depois'):
+        app_module = load_app()
+        workdir = tempfile.mkdtemp()
+        report = prepare_database(app_module, os.path.join(workdir, 'reports.db'))
+        if label == 'antes':
+            app_module.connect_db = legacy_connect(app_module)
+            conn = app_module.connect_db()
+            conn.close()
+        results[label] = run(app_module, *report)
+    
+    print(f"{READERS} leitores + 1 escritor por {DURATION_SECONDS}s")
+    print(f"{'modo':<8}{'leituras/s':>12}{'p50 (ms)':>10}{'p95 (ms)':>10}{'escritas/s':>12}")
+    for label, (latencies, writes) in results.items():
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"{label:<8}{len(latencies) / DURATION_SECONDS:>12.0f}{statistics.median(latencies):>10.2f}"
+              f"{p95:>10.2f}{writes / DURATION_SECONDS:>12.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Compara o custo por requisição de renderizar a página de relatório com
+render_template_string (compila o template a cada chamada) e com o
+registro de templates compilados (render_template).
+
+    python -m benchmarks.bench_templates
+"""
+from flask import render_template, render_template_string, url_for
+
+from benchmarks.common import load_app, make_summary_data, time_call
+
+def main():
+    app_module = load_app()
+    app = app_module.app
+    summary_data = make_summary_data()
+    contracts = sum(len(m["Contratos"]) for t in summary_data for m in t["Motivos"])
+    print(f"summary_data: {len(summary_data)} técnicos, {contracts} contratos")
+    
+    with app.test_request_context('/'):
+        # Mesmo contexto do resultado de um upload (upload_job): resumo sem as listas
+        # de contratos, que a página busca sob demanda em contracts_url
+        context = dict(summary_data=app_module.summary_for_page(summary_data),
+                       filename='bench.xlsx',
+                       staging_token='bench',
+                       contracts_url=url_for('get_staged_contracts', token='bench'),
+                       name_review=[])
+        app_module.compile_templates()
+        before = time_call(lambda: render_template_string(app_module.html_template, **context))
+        after = time_call(lambda: render_template('index.html', **context))
+        empty_before = time_call(lambda: render_template_string(app_module.html_template), repeat=50)
+        empty_after = time_call(lambda: render_template('index.html'), repeat=50)
+    
+    print(f"{'página':<22}{'antes (ms)':>12}{'depois (ms)':>13}")
+    print(f"{'upload vazio':<22}{empty_before:>12.2f}{empty_after:>13.2f}")
+    print(f"{'relatório grande':<22}{before:>12.2f}{after:>13.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Utilitários compartilhados pelos benchmarks
+"""
+import importlib.util
+import os
+import random
+import statistics
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ver16-Claude.py')
+
+def load_app():
+    """
+    Importa o ver16-Claude.py como módulo (o nome do arquivo não é um identificador válido)
+    """
+    spec = importlib.util.spec_from_file_location('nextall_app', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def time_call(func, repeat=20):
+    """
+    Executa func repetidas vezes e retorna a mediana do tempo em milissegundos
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def make_summary_data(technicians=60, motivos=25, contracts=40, seed=42):
+    """
+    Gera um summary_data sintético com o mesmo formato do upload_file
+    """
+    rng = random.Random(seed)
+    summary_data = []
+    for t in range(technicians):
+        motivos_list = []
+        total_os = 0
+        for m in range(motivos):
+            quantity = rng.randint(1, contracts)
+            total_os += quantity
+            motivos_list.append({
+                "Motivo": f"MAN - MOTIVO {m:02d}",
+                "Quantidade": quantity,
+                "Porcentagem": 0,
+                "Contratos": [str(rng.randint(1000, 99999)) for _ in range(quantity)]
+            })
+        for motivo in motivos_list:
+            motivo["Porcentagem"] = round(motivo["Quantidade"] / total_os * 100, 1)
+        summary_data.append({
+            "Técnico": f"Tecnico {t:03d} Silva",
+            "Quantidade de OS": total_os,
+            "Valor Total": total_os * 3,
+            "Motivos": sorted(motivos_list, key=lambda x: x["Quantidade"], reverse=True)
+        })
+    return summary_data
@@ -0,0 +1,151 @@
+"""
+Gera planilhas sintéticas no layout da exportação "Ordens de Serviço"
+(linhas de título, cabeçalho na linha 8, 23 colunas) com distribuições
+parecidas com as exportações reais em uploads/.
+
+    python -m benchmarks.generate_workbook 10000 /tmp/os-10k.xlsx
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+
+COLUMNS = [
+    'ID', 'Protocolo', 'ID Contrato', 'Cliente', 'CPF/CNPJ', 'Pop', 'Bairro', 'Tipo', 'Motivo',
+    'Classificações', 'Status', 'Criada', 'Agendamento', 'Check-in', 'Previsão Finalização',
+    'Encerrada', 'Responsável', 'Técnico(s) auxiliar(s)', 'Status Contrato', 'Plano', 'Usuário',
+    'Finalizado Por', 'Telefones',
+]
+
+# Frequência aproximada de cada motivo na exportação de 26/02
+MOTIVOS = {
+    'INS - INSTALAÇÃO - FTTH': 180,
+    'MAN - SEM ACESSO - SEM SINAL (LOSS)': 156,
+    'FIN - REMOÇÃO DA CTO - INADIMPLÊNCIA': 94,
+    'MAN - LENTIDÃO': 81,
+    'FIN - REMOÇÃO DE KIT - INADIMPLÊNCIA': 81,
+    'FIN - REMOÇÃO DA CTO - CANCELAMENTO': 43,
+    'FIN - REMOÇÃO DE KIT - CANCELAMENTO': 35,
+    'INS - MUDANÇA DE ENDEREÇO': 33,
+    'MAN - TROCA DE EQUIPAMENTO': 31,
+    'MAN - REATIVAÇÃO': 27,
+    'MAN - SEM ACESSO - COM SINAL': 27,
+    'MAN - SEM ACESSO - FIBRA ROMPIDA': 21,
+    'INS - REMOÇÃO DA CTO - MUDANÇA DE ENDEREÇO': 20,
+    'INS - INSTALAÇÃO - REPETIDOR': 19,
+    'MAN - CABO BAIXO': 18,
+    'MAN - SINAL ALTO': 16,
+    'INF - ROMPIMENTO DE REDE': 11,
+    'MAN - PREVENTIVA': 10,
+    'Entrega de Carnê': 10,
+    'Financeiro': 9,
+    'MAN - PROBLEMAS NA REDE WIFI (QUEDAS, ALCANCE, ETC.)': 8,
+    'MAN - MUDANÇA DE CÔMODO': 6,
+    'INF - AMPLIAÇÃO DE REDE': 3,
+    'Visita de Inspeção': 2,
+}
+
+TECHNICIANS = [
+    ('Talison Pereira Lima', 'talisonp'), ('Lucas Almeida Costa', 'lucasa'),
+    ('Evandro Sousa Silva', 'evandros'), ('Jedson Ribeiro Santos', 'jedsonr'),
+    ('Jadiel Conceição Moraes', 'jadielc'), ('Ramires Oliveira Nunes', 'ramireso'),
+    ('Daniel Ferreira Rocha', 'danielf'), ('Juceildo Martins Reis', 'juceildom'),
+    ('Ivanildo Amaral', 'ivanildoa'), ('Wanderson Barros Lopes', 'wandersonb'),
+    ('Izan Carvalho Dias', 'izanc'), ('Vinicius Mendes Araújo', 'viniciusm'),
+    ('Diego Silva Costa', 'diegos'), ('Marcos Venicius Silva Rocha', 'marcosv'),
+    ('Jhonata Humberto Silva Sousa', 'jhonatah'), ('Classios Gomes Pinto', 'classios'),
+    ('Ramiro Teixeira Cunha', 'ramirot'), ('Weslley Batista Freitas', 'weslleyb'),
+]
+# Incrementar quando o conteúdo gerado mudar (as planilhas ficam em cache nos benchmarks)
+GENERATOR_VERSION = 2
+AUX_SEPARATORS = [', ', '; ', ' / ', ' | ', '/', ';']
+OPERATORS = ['davylla', 'geiziane', 'samara', 'Hellen', 'anna']
+PLANS = ['450 MEGAS + PLAYHUB + QUALIFICA', '600 MEGAS', '300 MEGAS', '1 GIGA + PLAYHUB']
+BAIRROS = ['CENTRO', 'JARDIM CIDADE DOS LAGOS', 'VILA NOVA', 'COHAB', 'MARACANÃ', 'SÃO BENEDITO']
+
+def auxiliary_names(rng, responsible):
+    """
+    Sorteia os técnicos auxiliares (1/3 das OS não tem auxiliar), às vezes com
+    sobrenome, maiúsculas ou espaços extras, separados por ; / | ou vírgula
+    """
+    if rng.random() < 0.34:
+        return None
+    others = [name for name, _ in TECHNICIANS if name != responsible]
+    names = []
+    for name in rng.sample(others, rng.choices([1, 2, 3], weights=[80, 17, 3])[0]):
+        parts = name.split()
+        variant = rng.random()
+        if variant < 0.75:
+            names.append(parts[0].lower())
+        elif variant < 0.9:
+            names.append(' '.join(parts[:2]))
+        else:
+            names.append(f' {parts[0].upper()} ')
+    return rng.choice(AUX_SEPARATORS).join(names)
+
+def generate_rows(rows, seed=42):
+    """
+    Produz as linhas de dados (listas com as 23 colunas). Como na exportação real,
+    todas as células preenchidas são texto, inclusive ID, Protocolo e ID Contrato
+    """
+    rng = random.Random(seed)
+    motivos = list(MOTIVOS)
+    weights = list(MOTIVOS.values())
+    start = datetime(2025, 2, 1, 8, 0, 0)
+    tech_weights = [rng.randint(1, 10) for _ in TECHNICIANS]
+    for i in range(rows):
+        responsible, login = rng.choices(TECHNICIANS, weights=tech_weights)[0]
+        created = start + timedelta(minutes=i * 3)
+        closed = created + timedelta(hours=rng.randint(1, 48))
+        yield [
+            str(47000 + i),
+            str(250225000000 + i),
+            str(rng.randint(1000, 12000)),
+            f'CLIENTE {i:06d}',
+            f'{rng.randint(10**10, 10**11 - 1)}',
+            'Viana-MA',
+            rng.choice(BAIRROS),
+            'Externa',
+            rng.choices(motivos, weights=weights)[0],
+            None,
+            'Encerrada',
+            created.strftime('%Y-%m-%d %H:%M:%S'),
+            created.strftime('%Y-%m-%d %H:%M:%S'),
+            closed.strftime('%Y-%m-%d %H:%M:%S'),
+            None,
+            closed.strftime('%Y-%m-%d %H:%M:%S'),
+            responsible,
+            auxiliary_names(rng, responsible),
+            ' Ativo ',
+            rng.choice(PLANS),
+            rng.choice(OPERATORS),
+            login,
+            f'(98) 9{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}',
+        ]
+
+def generate_workbook(path, rows, seed=42):
+    """
+    Grava uma planilha com o mesmo layout da exportação: duas linhas vazias,
+    título, total de OS e cabeçalho na linha 8
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Ordens de Serviço')
+    sheet.append([])
+    sheet.append([])
+    sheet.append([None, 'Relatório Ordem de Serviço'])
+    sheet.append([])
+    sheet.append([None, None, 'Total'])
+    sheet.append([None, None, rows])
+    sheet.append([])
+    sheet.append(COLUMNS)
+    for row in generate_rows(rows, seed):
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('uso: python -m benchmarks.generate_workbook <linhas> <arquivo.xlsx>')
+        sys.exit(1)
+    generate_workbook(sys.argv[2], int(sys.argv[1]))
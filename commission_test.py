@@ -0,0 +1,156 @@
+"""
+Regras de comissão: prioridade por especificidade, períodos de validade, papel
+(responsável/auxiliar), tipo e motivo, rotas /commission_rules e restauração
+de OS com o valor registrado na remoção
+"""
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import pandas as pd
+
+from benchmarks.common import load_app
+
+def assignment_rows(*rows):
+    """
+    Atribuições no formato de build_assignments: (motivo, tipo, papel, data)
+    """
+    return pd.DataFrame({
+        'Motivo': [row[0] for row in rows],
+        'Tipo': pd.Series([row[1] for row in rows], dtype='string'),
+        'papel': [row[2] for row in rows],
+        'Data': pd.to_datetime([row[3] for row in rows]),
+    })
+
+def rule(rule_id, rate, motivo=None, tipo=None, role=None, valid_from=None, valid_to=None):
+    return {'id': rule_id, 'motivo': motivo, 'tipo': tipo, 'role': role,
+            'valid_from': valid_from, 'valid_to': valid_to, 'rate': rate}
+
+class CommissionValuesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app_module = load_app()
+
+    def values(self, rules, *rows):
+        rule_set = self.app_module.compile_commission_rules(rules)
+        return self.app_module.commission_values(assignment_rows(*rows), rule_set).tolist()
+
+    def test_most_specific_rule_wins(self):
+        rules = [
+            rule(1, 3),
+            rule(2, 5, motivo='Instalação'),
+            rule(3, 7, motivo='Instalação', role='auxiliar'),
+        ]
+        self.assertEqual(self.values(rules,
+                                     ('Instalação', 'Externa', 'auxiliar', '2025-01-10'),
+                                     ('Instalação', 'Externa', 'responsavel', '2025-01-10'),
+                                     ('Suporte', 'Externa', 'auxiliar', '2025-01-10')),
+                         [7.0, 5.0, 3.0])
+
+    def test_tie_goes_to_latest_rule(self):
+        rules = [rule(1, 4, motivo='Suporte'), rule(2, 6, tipo='Interna')]
+        self.assertEqual(self.values(rules, ('Suporte', 'Interna', 'responsavel', '2025-01-10')), [6.0])
+
+    def test_date_range_is_inclusive_and_needs_a_date(self):
+        rules = [rule(1, 3), rule(2, 10, valid_from='2025-01-01', valid_to='2025-01-31')]
+        self.assertEqual(self.values(rules,
+                                     ('Suporte', None, 'responsavel', '2025-01-01'),
+                                     ('Suporte', None, 'responsavel', '2025-01-31'),
+                                     ('Suporte', None, 'responsavel', '2025-02-01'),
+                                     ('Suporte', None, 'responsavel', None)),
+                         [10.0, 10.0, 3.0, 3.0])
+
+    def test_open_ended_ranges(self):
+        rules = [rule(1, 1, valid_from='2025-02-01'), rule(2, 2, valid_to='2025-01-31')]
+        self.assertEqual(self.values(rules,
+                                     ('Suporte', None, 'auxiliar', '2025-01-15'),
+                                     ('Suporte', None, 'auxiliar', '2025-03-01')),
+                         [2.0, 1.0])
+
+    def test_roles(self):
+        rules = [rule(1, 4, role='responsavel'), rule(2, 2, role='auxiliar')]
+        self.assertEqual(self.values(rules,
+                                     ('Suporte', 'Externa', 'responsavel', '2025-01-10'),
+                                     ('Suporte', 'Externa', 'auxiliar', '2025-01-10')),
+                         [4.0, 2.0])
+
+    def test_tipo_and_motivo_matching(self):
+        rules = [rule(1, 8, tipo='Externa'), rule(2, 9, motivo='Instalação', tipo='Interna')]
+        self.assertEqual(self.values(rules,
+                                     ('Suporte', 'Externa', 'responsavel', '2025-01-10'),
+                                     ('Instalação', 'Interna', 'responsavel', '2025-01-10'),
+                                     ('Suporte', 'Interna', 'responsavel', '2025-01-10'),
+                                     ('Suporte', None, 'responsavel', '2025-01-10')),
+                         [8.0, 9.0, 0.0, 0.0])
+
+    def test_no_rules(self):
+        self.assertEqual(self.values([], ('Suporte', None, 'responsavel', None)), [0.0])
+
+class CommissionRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.app_module = load_app()
+        self.app_module.DATABASE = os.path.join(tempfile.mkdtemp(), 'reports.db')
+        self.app_module.init_db()
+        self.client = self.app_module.app.test_client()
+
+    def test_create_rule_set(self):
+        self.assertEqual(self.client.get('/commission_rules').get_json()['active_version'], 1)
+        response = self.client.post('/commission_rules', json={
+            'description': 'Instalação paga mais',
+            'rules': [{'rate': 3}, {'motivo': 'Instalação', 'role': 'responsavel', 'rate': 5}],
+        })
+        self.assertEqual(response.get_json(), {'success': True, 'version': 2})
+        listing = self.client.get('/commission_rules').get_json()
+        self.assertEqual(listing['active_version'], 2)
+        self.assertEqual([r['rate'] for r in listing['rule_sets'][1]['rules']], [3, 5])
+
+        with self.app_module.app.app_context():
+            rules = self.app_module.load_commission_rules(self.app_module.get_db(), 2)
+        values = self.app_module.commission_values(assignment_rows(
+            ('Instalação', None, 'responsavel', None),
+            ('Instalação', None, 'auxiliar', None)), rules)
+        self.assertEqual(values.tolist(), [5.0, 3.0])
+
+    def test_invalid_rules_are_rejected(self):
+        for payload in ({}, {'rules': []}, {'rules': [{'role': 'gerente', 'rate': 1}]},
+                        {'rules': [{'rate': -1}]}, {'rules': [{'rate': 1, 'valid_from': '01/02/2025'}]},
+                        {'rules': [{'rate': 1, 'valid_from': '2025-02-01', 'valid_to': '2025-01-01'}]}):
+            with self.subTest(payload=payload):
+                response = self.client.post('/commission_rules', json=payload)
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(response.get_json()['success'])
+        self.assertEqual(self.client.get('/commission_rules').get_json()['active_version'], 1)
+
+    def test_restore_requires_a_removal_record(self):
+        summary_data = [{
+            'Técnico': 'Evandro Sousa', 'Quantidade de OS': 2, 'Valor Total': 12.0,
+            'Motivos': [{'Motivo': 'Instalação', 'Quantidade': 2, 'Porcentagem': 100.0,
+                         'Contratos': ['10', '20'], 'Valores': [5.0, 7.0]}],
+        }]
+        conn = self.app_module.connect_db()
+        c = conn.cursor()
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        c.execute('INSERT INTO reports (date, updated_date, filename, data) VALUES (?, ?, ?, ?)',
+                  (now, now, 'teste.xlsx', '[]'))
+        report_id = c.lastrowid
+        self.app_module.insert_summary_rows(c, report_id, summary_data)
+        conn.commit()
+        conn.close()
+
+        item = {'contract_id': '30', 'technician': 'Evandro Sousa', 'motivo': 'Instalação'}
+        response = self.client.post('/restore_os/batch', json={'report_id': report_id, 'items': [item]})
+        self.assertEqual(response.get_json()['applied'], [False])
+        self.assertEqual(response.get_json()['technicians'][0]['Valor Total'], 12.0)
+
+        item = dict(item, contract_id='20')
+        response = self.client.post('/remove_os/batch', json={'report_id': report_id,
+                                                              'items': [dict(item, removal_reason='Duplicada')]})
+        self.assertEqual(response.get_json()['technicians'][0]['Valor Total'], 5.0)
+        response = self.client.post('/restore_os/batch', json={'report_id': report_id, 'items': [item]})
+        self.assertEqual(response.get_json()['applied'], [True])
+        self.assertEqual(response.get_json()['technicians'][0]['Quantidade de OS'], 2)
+        self.assertEqual(response.get_json()['technicians'][0]['Valor Total'], 12.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Exclusões de motivo: tipos exact/prefix/regex, validação em /motivo_exclusions
+e invalidação do cache de uploads quando o cadastro muda
+"""
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from benchmarks.common import load_app
+
+class ExcludedMotivoMaskTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app_module = load_app()
+
+    def excluded(self, exclusions, motivos):
+        compiled = self.app_module.compile_motivo_exclusions(exclusions)
+        return self.app_module.excluded_motivo_mask(pd.Series(motivos, dtype=object), compiled).tolist()
+
+    def test_exact(self):
+        self.assertEqual(self.excluded([('exact', 'Financeiro')], ['Financeiro', 'Financeiro 2', 'financeiro', None]),
+                         [True, False, False, False])
+
+    def test_prefix(self):
+        self.assertEqual(self.excluded([('prefix', 'FIN -')], ['FIN - Boleto', 'FIN-Boleto', 'MAN - FIN -']),
+                         [True, False, False])
+
+    def test_regex(self):
+        self.assertEqual(self.excluded([('regex', 'carn[eê]$')], ['Entrega de Carnê', 'Entrega de carne', 'Carnê extra']),
+                         [False, True, False])
+
+    def test_regex_patterns_are_compiled_separately(self):
+        # Flag no início do padrão e referência a grupo só funcionam com cada padrão compilado à parte
+        exclusions = [('regex', '(?i)^fin'), ('regex', r'(\w)\1$'), ('exact', 'Suporte')]
+        self.assertEqual(self.excluded(exclusions, ['FINANCEIRO', 'financeiro', 'Visita xx', 'Visita', 'Suporte']),
+                         [True, True, True, False, True])
+
+    def test_kinds_combined(self):
+        exclusions = [('exact', 'Financeiro'), ('prefix', 'ADM'), ('regex', 'teste')]
+        self.assertEqual(self.excluded(exclusions, ['Financeiro', 'ADM - Cadastro', 'OS de teste', 'Instalação']),
+                         [True, True, True, False])
+
+class MotivoExclusionRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.app_module = load_app()
+        self.app_module.DATABASE = os.path.join(tempfile.mkdtemp(), 'reports.db')
+        self.app_module.init_db()
+        self.client = self.app_module.app.test_client()
+
+    def test_invalid_exclusions_are_rejected(self):
+        for payload, error in (
+            ({'kind': 'regex', 'pattern': '(fin'}, 'Expressão regular inválida'),
+            ({'kind': 'regex', 'pattern': '*fin'}, 'Expressão regular inválida'),
+            ({'kind': 'contains', 'pattern': 'fin'}, 'Tipo deve ser'),
+            ({'kind': 'exact', 'pattern': '  '}, 'Informe o padrão'),
+            (None, 'Informe o tipo e o padrão'),
+        ):
+            with self.subTest(payload=payload):
+                response = self.client.post('/motivo_exclusions', json=payload)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(error, response.get_json()['error'])
+        patterns = [row['pattern'] for row in self.client.get('/motivo_exclusions').get_json()['exclusions']]
+        self.assertEqual(sorted(patterns), sorted(self.app_module.EXCLUDED_MOTIVOS))
+
+    def test_add_duplicate_and_delete(self):
+        response = self.client.post('/motivo_exclusions', json={'kind': 'prefix', 'pattern': 'FIN -'})
+        self.assertTrue(response.get_json()['success'])
+        exclusion_id = response.get_json()['id']
+        duplicate = self.client.post('/motivo_exclusions', json={'kind': 'prefix', 'pattern': 'FIN -'})
+        self.assertEqual(duplicate.status_code, 400)
+        self.assertEqual(self.client.delete(f'/motivo_exclusions/{exclusion_id}').status_code, 200)
+        self.assertEqual(self.client.delete(f'/motivo_exclusions/{exclusion_id}').status_code, 404)
+
+    def test_changing_exclusions_invalidates_cached_summaries(self):
+        app_module = self.app_module
+        summary_data = [{'Técnico': 'Evandro Sousa', 'Quantidade de OS': 1, 'Valor Total': 3.0, 'Motivos': []}]
+        with app_module.app.app_context():
+            before = app_module.get_pipeline_version()
+            app_module.store_cached_summary('arquivo', summary_data)
+            self.assertEqual(app_module.get_cached_summary('arquivo'), (summary_data, []))
+
+        exclusion_id = self.client.post('/motivo_exclusions', json={'kind': 'regex', 'pattern': '^MAN'}).get_json()['id']
+        with app_module.app.app_context():
+            self.assertNotEqual(app_module.get_pipeline_version(), before)
+            self.assertIsNone(app_module.get_cached_summary('arquivo'))
+
+        # Voltando ao cadastro anterior, o resultado guardado para ele volta a valer
+        self.client.delete(f'/motivo_exclusions/{exclusion_id}')
+        with app_module.app.app_context():
+            self.assertEqual(app_module.get_pipeline_version(), before)
+            self.assertEqual(app_module.get_cached_summary('arquivo'), (summary_data, []))
+
+if __name__ == '__main__':
+    unittest.main()
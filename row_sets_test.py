@@ -0,0 +1,80 @@
+"""
+OS de origem guardadas (os_row_sets/os_rows): limpeza dos conjuntos sem uso e
+recálculo de relatório a partir de um conjunto que sobreviveu à limpeza
+"""
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import pandas as pd
+
+from benchmarks.common import load_app
+
+def os_rows(motivo):
+    return pd.DataFrame({
+        'ID': [1, 2, 3],
+        'ID Contrato': [10, 20, 30],
+        'Motivo': [motivo, motivo, 'Suporte'],
+        'Responsável': ['Evandro Sousa', 'Evandro Sousa', 'Marcos Rocha'],
+        'Técnico(s) auxiliar(s)': ['Marcos', None, None],
+        'Tipo': ['Externa', 'Externa', 'Interna'],
+        'Encerrada': ['2025-02-26 09:00:00', '2025-02-26 10:00:00', '2025-02-26 11:00:00'],
+    })
+
+class RowSetPruningTest(unittest.TestCase):
+    def setUp(self):
+        self.app_module = load_app()
+        self.app_module.DATABASE = os.path.join(tempfile.mkdtemp(), 'reports.db')
+        self.app_module.init_db()
+        self.app_module.compile_templates()
+        self.client = self.app_module.app.test_client()
+        self.conn = self.app_module.connect_db()
+        self.addCleanup(self.conn.close)
+
+    def row_set_ids(self):
+        return {row[0] for row in self.conn.execute('SELECT id FROM os_row_sets')}
+
+    def os_values(self):
+        return {row[0] for row in self.conn.execute('SELECT value FROM os_values')}
+
+    def test_referenced_row_set_survives_pruning_and_recomputes(self):
+        app_module = self.app_module
+        expired = time.time() - 2 * app_module.STAGING_TTL_SECONDS - 60
+        recent = time.time() - app_module.STAGING_TTL_SECONDS
+
+        saved = app_module.store_os_rows(self.conn, 'salvo', os_rows('Instalação'))
+        orphan = app_module.store_os_rows(self.conn, 'descartado', os_rows('Só no descartado'))
+        pending = app_module.store_os_rows(self.conn, 'aguardando', os_rows('Instalação'))
+        self.conn.execute('UPDATE os_row_sets SET last_used = ? WHERE id IN (?, ?)', (expired, saved, orphan))
+        self.conn.execute('UPDATE os_row_sets SET last_used = ? WHERE id = ?', (recent, pending))
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        c = self.conn.execute('''
+            INSERT INTO reports (date, updated_date, filename, data, row_set_id) VALUES (?, ?, ?, ?, ?)
+        ''', (now, now, 'salvo.xlsx', '[]', saved))
+        report_id = c.lastrowid
+        self.conn.commit()
+
+        # A limpeza roda quando um novo conjunto é guardado
+        latest = app_module.store_os_rows(self.conn, 'novo', os_rows('Instalação'))
+        self.assertEqual(self.row_set_ids(), {saved, pending, latest})
+        self.assertNotIn('Só no descartado', self.os_values())
+        self.assertIn('Instalação', self.os_values())
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM os_rows WHERE row_set_id = ?',
+                                           (orphan,)).fetchone()[0], 0)
+
+        response = self.client.post(f'/report/{report_id}/recompute', headers={'Accept': 'application/json'})
+        self.assertEqual(response.status_code, 202)
+        status_url = response.get_json()['status_url']
+        deadline = time.time() + 30
+        job = self.client.get(status_url).get_json()
+        while job['status'] not in ('done', 'error') and time.time() < deadline:
+            time.sleep(0.05)
+            job = self.client.get(status_url).get_json()
+        self.assertEqual(job['status'], 'done', job['error'])
+        self.assertEqual(job['rows'], 3)
+        self.assertEqual(self.client.get(job['result_url']).status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
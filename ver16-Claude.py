@@ -1,18 +1,242 @@
 import pandas as pd
-from flask import Flask, render_template_string, request, redirect, url_for, jsonify
+from flask import Flask, render_template, request, redirect, url_for, jsonify, make_response, g, has_app_context
+from jinja2 import DictLoader
 import os
-from collections import Counter
 import re
 import sqlite3
 from datetime import datetime
 import json
+import hashlib
+import tempfile
+import secrets
+import threading
+import multiprocessing
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from openpyxl import load_workbook
 
 app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+DATABASE = 'reports.db'
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 16 * 1024
+
+# Limites (em segundos) dos histogramas de duração expostos em /metrics
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Planilha exportada pelo sistema de OS e as únicas colunas que o cálculo de comissão usa.
+# Os lotes levam apenas estas colunas; as demais (Cliente, CPF/CNPJ, Telefones...) são
+# descartadas linha a linha. O openpyxl ainda converte todas as células de cada linha.
+OS_SHEET_NAME = "Ordens de Serviço"
+OS_PIPELINE_COLUMNS = ['ID', 'ID Contrato', 'Motivo', 'Responsável', 'Técnico(s) auxiliar(s)']
+OS_ID_COLUMNS = ['ID', 'ID Contrato']
+# Logins de quem abriu e de quem encerrou a OS; opcionais, alimentam o cadastro de técnicos
+OS_LOGIN_COLUMNS = ['Usuário', 'Finalizado Por']
+# Tipo (Externa/Interna) e data de encerramento; opcionais, usados pelas regras de comissão
+OS_RULE_COLUMNS = ['Tipo', 'Encerrada']
+OS_OPTIONAL_COLUMNS = OS_RULE_COLUMNS + OS_LOGIN_COLUMNS
+READ_BATCH_SIZE = 5000
+REPORTS_PAGE_SIZE = 20
+# Resultados de upload ainda não salvos ficam no servidor, identificados por um token
+STAGING_TTL_SECONDS = 2 * 60 * 60
+STAGING_MAX_ITEMS = 16
+REPORTS_MAX_PAGE_SIZE = 100
+CONTRACTS_PAGE_SIZE = 100
+CONTRACTS_MAX_PAGE_SIZE = 500
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Resultados em cache (arquivo + versão do processamento); os menos usados saem primeiro
+UPLOAD_CACHE_MAX_ITEMS = 200
+# Quantos valores por consulta "IN (...)" ao buscar códigos do dicionário de OS
+SQL_IN_CHUNK = 500
+# Uploads são processados em segundo plano por poucas threads, para não ocupar os
+# workers do Flask; além dos que estão rodando, no máximo UPLOAD_QUEUE_LIMIT esperam na fila
+UPLOAD_WORKERS = 2
+UPLOAD_QUEUE_LIMIT = 8
+# Envios com várias planilhas (uma exportação por dia) são lidos em paralelo em
+# processos separados, deixando um núcleo livre para o servidor
+PARSE_PROCESSES = max(1, (os.cpu_count() or 2) - 1)
+
+# Regras de comissão: motivos que não entram no cálculo e valor pago por OS.
+# Ambos agora são cadastrados no banco (motivo_exclusions e commission_rules); as
+# constantes abaixo são o cadastro inicial e o valor dos relatórios salvos antes disso.
+EXCLUDED_MOTIVOS = ['Financeiro', 'Entrega de Carnê']
+COMMISSION_PER_OS = 3
+# Uma exclusão casa com o motivo exato, com o início dele ("FIN -") ou com uma expressão regular
+MOTIVO_EXCLUSION_KINDS = ('exact', 'prefix', 'regex')
+# Incrementar quando a lógica de agregação mudar, para invalidar o cache de uploads:
+#   2 - auxiliares resolvidos pelo cadastro de técnicos
+#   3 - nomes comparados sem acentos, com aproximação; cada técnico é creditado no
+#       máximo uma vez por OS (antes, um auxiliar que levava ao responsável ou a
+#       outro técnico já creditado na OS ganhava um crédito com o primeiro nome)
+#   4 - comissão pelas regras cadastradas
+#   5 - OS repetidas entre arquivos: vale a cópia encerrada por último
+AGGREGATION_VERSION = 5
+
+# Um login só é associado a um técnico quando aparece com ele como responsável em
+# pelo menos LOGIN_MIN_ROWS OS e em LOGIN_MATCH_SHARE delas
+LOGIN_MIN_ROWS = 3
+LOGIN_MATCH_SHARE = 0.8
+# Ordem de preferência ao resolver o nome de um auxiliar
+ALIAS_KINDS = ('login', 'first_name', 'name_part')
+# Nomes de auxiliares sem correspondência exata são comparados (distância de edição)
+# com os primeiros nomes e logins que começam com as mesmas letras; nomes curtos não
+FUZZY_KINDS = ('login', 'first_name')
+FUZZY_BLOCK_PREFIX = 2
+FUZZY_MIN_LENGTH = 5
+# Quantos valores distintos da coluna de auxiliares manter já interpretados entre uploads
+AUX_PARSE_CACHE_SIZE = 8192
+
+def connect_db():
+    """
+    Abre uma conexão configurada: WAL (leituras não esperam as escritas),
+    synchronous=NORMAL, espera por lock, cache de páginas maior e chaves estrangeiras ativas
+    """
+    conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+def get_db():
+    """
+    Conexão da requisição atual: aberta na primeira chamada e reaproveitada
+    por todas as consultas até o fim da requisição
+    """
+    if 'db' not in g:
+        g.db = connect_db()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()  # Nunca deixar uma transação pela metade
+        conn.close()
+
+stage_metrics = {}
+metrics_lock = threading.Lock()
+
+def record_stage(stage, seconds, rows=None):
+    """
+    Acumula a duração (e as linhas processadas) de uma etapa no histograma da etapa
+    """
+    with metrics_lock:
+        metric = stage_metrics.setdefault(stage, {
+            'buckets': [0] * len(STAGE_BUCKETS),
+            'sum': 0.0,
+            'count': 0,
+            'rows': 0,
+        })
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                metric['buckets'][i] += 1
+        metric['sum'] += seconds
+        metric['count'] += 1
+        metric['rows'] += rows or 0
+
+@contextmanager
+def timed_stage(stage):
+    """
+    Mede a duração de um trecho do pipeline. O bloco pode informar quantas linhas
+    processou em span['rows']. Dentro de uma requisição ou de um job de upload a
+    medição também vai para g.stage_timings (detalhamento por upload).
+    """
+    span = {'stage': stage, 'rows': None}
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span['seconds'] = round(time.perf_counter() - start, 6)
+        record_stage(stage, span['seconds'], span['rows'])
+        if has_app_context():
+            g.setdefault('stage_timings', []).append(span)
+
+def render_metrics():
+    """
+    Formata os histogramas no formato texto do Prometheus
+    """
+    lines = [
+        '# HELP nextall_stage_duration_seconds Duração das etapas do pipeline e das rotas.',
+        '# TYPE nextall_stage_duration_seconds histogram',
+    ]
+    with metrics_lock:
+        snapshot = {stage: dict(metric, buckets=list(metric['buckets'])) for stage, metric in stage_metrics.items()}
+    for stage, metric in sorted(snapshot.items()):
+        for bound, count in zip(STAGE_BUCKETS, metric['buckets']):
+            lines.append(f'nextall_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'nextall_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {metric["count"]}')
+        lines.append(f'nextall_stage_duration_seconds_sum{{stage="{stage}"}} {metric["sum"]:.6f}')
+        lines.append(f'nextall_stage_duration_seconds_count{{stage="{stage}"}} {metric["count"]}')
+    lines.append('# HELP nextall_stage_rows_total Linhas processadas por etapa.')
+    lines.append('# TYPE nextall_stage_rows_total counter')
+    for stage, metric in sorted(snapshot.items()):
+        lines.append(f'nextall_stage_rows_total{{stage="{stage}"}} {metric["rows"]}')
+    
+    with aux_parse_lock:
+        aux_stats = dict(aux_parse_stats, entries=len(aux_parse_cache))
+    lines.extend([
+        '# HELP nextall_aux_parse_rows_total Valores da coluna de auxiliares recebidos.',
+        '# TYPE nextall_aux_parse_rows_total counter',
+        f'nextall_aux_parse_rows_total {aux_stats["rows"]}',
+        '# HELP nextall_aux_parse_distinct_total Valores distintos por upload (interpretados no máximo uma vez).',
+        '# TYPE nextall_aux_parse_distinct_total counter',
+        f'nextall_aux_parse_distinct_total {aux_stats["distinct"]}',
+        '# HELP nextall_aux_parse_cache_hits_total Valores distintos já interpretados em uploads anteriores.',
+        '# TYPE nextall_aux_parse_cache_hits_total counter',
+        f'nextall_aux_parse_cache_hits_total {aux_stats["hits"]}',
+        '# HELP nextall_aux_parse_cache_misses_total Valores distintos interpretados agora.',
+        '# TYPE nextall_aux_parse_cache_misses_total counter',
+        f'nextall_aux_parse_cache_misses_total {aux_stats["misses"]}',
+        '# HELP nextall_aux_parse_cache_entries Valores guardados no cache.',
+        '# TYPE nextall_aux_parse_cache_entries gauge',
+        f'nextall_aux_parse_cache_entries {aux_stats["entries"]}',
+    ])
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    if request.endpoint and request.endpoint != 'metrics' and 'request_start' in g:
+        record_stage(f'route.{request.endpoint}', time.perf_counter() - g.request_start)
+    return response
+
+def log_upload_timings(filename, file_hash, cache_hit, total_seconds):
+    """
+    Grava o detalhamento de tempos de um upload para acompanhar regressões entre exportações
+    """
+    stages = g.get('stage_timings', [])
+    rows = next((span['rows'] for span in stages if span['stage'] == 'parse'), None)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO upload_timings (created_date, filename, file_hash, cache_hit, rows, total_seconds, stages)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        filename,
+        file_hash,
+        int(cache_hit),
+        rows,
+        round(total_seconds, 6),
+        json.dumps(stages)
+    ))
+    conn.commit()
+
 def init_db():
-    conn = sqlite3.connect('reports.db')
+    conn = connect_db()
     c = conn.cursor()
     
     # Existing table
@@ -25,6 +249,21 @@ def init_db():
         )
     ''')
     
+    # Versão do relatório: incrementada a cada edição, usada nos ETags das páginas
+    c.execute('PRAGMA table_info(reports)')
+    report_columns = {row[1] for row in c.fetchall()}
+    if 'version' not in report_columns:
+        c.execute('ALTER TABLE reports ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    if 'updated_date' not in report_columns:
+        c.execute('ALTER TABLE reports ADD COLUMN updated_date TIMESTAMP')
+        c.execute('UPDATE reports SET updated_date = date')
+    # Versão das regras de comissão usada no cálculo; relatórios antigos usaram o valor fixo (versão 1)
+    if 'rule_set_version' not in report_columns:
+        c.execute('ALTER TABLE reports ADD COLUMN rule_set_version INTEGER NOT NULL DEFAULT 1')
+    # OS de origem do relatório (os_row_sets), para recalcular sem a planilha
+    if 'row_set_id' not in report_columns:
+        c.execute('ALTER TABLE reports ADD COLUMN row_set_id INTEGER REFERENCES os_row_sets(id)')
+    
     # New table for removed OS
     c.execute('''
         CREATE TABLE IF NOT EXISTS removed_os (
@@ -38,10 +277,1028 @@ def init_db():
             FOREIGN KEY (report_id) REFERENCES reports(id)
         )
     ''')
+    # Valor que a OS removida rendia, devolvido ao técnico se ela for restaurada
+    c.execute('PRAGMA table_info(removed_os)')
+    if 'commission' not in {row[1] for row in c.fetchall()}:
+        c.execute(f'ALTER TABLE removed_os ADD COLUMN commission NUMERIC NOT NULL DEFAULT {COMMISSION_PER_OS}')
+    
+    # Resumo normalizado: técnico -> motivo -> contratos. Leituras e edições usam só
+    # estas tabelas; reports.data (obrigatória no esquema antigo) fica com '[]'.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS report_technician (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            technician TEXT NOT NULL,
+            technician_key TEXT NOT NULL,
+            os_count INTEGER NOT NULL,
+            total_value NUMERIC NOT NULL,
+            FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS report_motivo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER NOT NULL,
+            report_technician_id INTEGER NOT NULL,
+            technician_key TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            motivo TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            percentage REAL NOT NULL,
+            FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE,
+            FOREIGN KEY (report_technician_id) REFERENCES report_technician(id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS report_contract (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER NOT NULL,
+            report_motivo_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            contract_id TEXT NOT NULL,
+            FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE,
+            FOREIGN KEY (report_motivo_id) REFERENCES report_motivo(id) ON DELETE CASCADE
+        )
+    ''')
+    # Comissão de cada OS (depende do motivo, tipo, papel e data); antes era sempre COMMISSION_PER_OS
+    c.execute('PRAGMA table_info(report_contract)')
+    if 'commission' not in {row[1] for row in c.fetchall()}:
+        c.execute(f'ALTER TABLE report_contract ADD COLUMN commission NUMERIC NOT NULL DEFAULT {COMMISSION_PER_OS}')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_date ON reports (date, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_technician_report ON report_technician (report_id, position)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_motivo_lookup ON report_motivo (report_id, technician_key, motivo)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_contract_motivo ON report_contract (report_motivo_id, contract_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_contract_report ON report_contract (report_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_contract_contract ON report_contract (contract_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_contract_position ON report_contract (report_motivo_id, position)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_removed_os_contract ON removed_os (report_id, contract_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_removed_os_group ON removed_os (report_id, technician, motivo)')
+    # Distribuição de motivos do relatório (gráfico), mantida a cada edição
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS report_motivo_totals (
+            report_id INTEGER NOT NULL,
+            motivo TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            percentage REAL NOT NULL,
+            PRIMARY KEY (report_id, motivo),
+            FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE
+        )
+    ''')
+    migrate_report_data(c)
+    migrate_chart_aggregates(c)
+    
+    # Motivos que não entram na comissão, mantidos pelo administrador
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'motivo_exclusions'")
+    exclusions_created = c.fetchone() is None
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS motivo_exclusions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL CHECK (kind IN ('exact', 'prefix', 'regex')),
+            pattern TEXT NOT NULL,
+            created_date TIMESTAMP NOT NULL,
+            UNIQUE (kind, pattern)
+        )
+    ''')
+    if exclusions_created:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        c.executemany('''
+            INSERT INTO motivo_exclusions (kind, pattern, created_date) VALUES ('exact', ?, ?)
+        ''', [(motivo, now) for motivo in EXCLUDED_MOTIVOS])
+    
+    # Regras de comissão. Cada conjunto é imutável: alterar as regras cria uma nova versão,
+    # e cada relatório guarda a versão com que foi calculado. Campos nulos valem para qualquer valor.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS commission_rule_sets (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_date TIMESTAMP NOT NULL,
+            description TEXT
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS commission_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rule_set_version INTEGER NOT NULL,
+            motivo TEXT,
+            tipo TEXT,
+            role TEXT CHECK (role IN ('responsavel', 'auxiliar')),
+            valid_from DATE,
+            valid_to DATE,
+            rate NUMERIC NOT NULL,
+            FOREIGN KEY (rule_set_version) REFERENCES commission_rule_sets(version)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_commission_rules_version ON commission_rules (rule_set_version)')
+    c.execute('SELECT COUNT(*) FROM commission_rule_sets')
+    if c.fetchone()[0] == 0:
+        # Versão 1: o valor fixo por OS usado até aqui
+        c.execute('''
+            INSERT INTO commission_rule_sets (version, created_date, description) VALUES (1, ?, ?)
+        ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), f'Valor fixo de R$ {COMMISSION_PER_OS} por OS'))
+        c.execute('INSERT INTO commission_rules (rule_set_version, rate) VALUES (1, ?)', (COMMISSION_PER_OS,))
+    
+    # Cadastro de técnicos: nome completo normalizado e os apelidos que levam a ele
+    # (primeiro nome, demais partes do nome e logins do sistema de OS)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS technicians (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            first_seen TIMESTAMP NOT NULL,
+            last_seen TIMESTAMP NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS technician_aliases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            technician_id INTEGER NOT NULL,
+            alias TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            UNIQUE (alias, kind, technician_id),
+            FOREIGN KEY (technician_id) REFERENCES technicians(id) ON DELETE CASCADE
+        )
+    ''')
+    migrate_technician_registry(c)
+    
+    # Resultados de upload retirados da memória aguardando o "Salvar Relatório"
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS staged_uploads (
+            token TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            data JSON NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    
+    # Cache de resultados por conteúdo do arquivo enviado
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_cache (
+            file_hash TEXT NOT NULL,
+            pipeline_version TEXT NOT NULL,
+            data JSON NOT NULL,
+            created_date TIMESTAMP NOT NULL,
+            PRIMARY KEY (file_hash, pipeline_version)
+        )
+    ''')
+    c.execute('PRAGMA table_info(upload_cache)')
+    cache_columns = {row[1] for row in c.fetchall()}
+    if 'name_review' not in cache_columns:
+        c.execute('ALTER TABLE upload_cache ADD COLUMN name_review JSON')
+    # Último uso de cada resultado, para descartar os menos usados
+    if 'last_used' not in cache_columns:
+        c.execute('ALTER TABLE upload_cache ADD COLUMN last_used REAL NOT NULL DEFAULT 0')
+    
+    # OS lidas de cada upload, antes das exclusões de motivo, em formato colunar
+    # compacto: textos repetidos (motivo, tipo, nomes, logins) viram códigos de
+    # os_values. Um conjunto é compartilhado pelos relatórios salvos do mesmo arquivo.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS os_values (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            value TEXT NOT NULL UNIQUE
+        )
+    ''')
+    # Conjuntos antigos guardavam só as OS que passaram pelas exclusões da época e não
+    # servem para recalcular com outras; descartá-los (os relatórios perdem o "Recalcular")
+    c.execute('PRAGMA table_info(os_row_sets)')
+    if 'exclusions' in {row[1] for row in c.fetchall()}:
+        c.execute('UPDATE reports SET row_set_id = NULL')
+        c.execute('UPDATE upload_jobs SET row_set_id = NULL')
+        c.execute('DROP TABLE os_rows')
+        c.execute('DROP TABLE os_row_sets')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS os_row_sets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_hash TEXT NOT NULL UNIQUE,
+            rows INTEGER NOT NULL,
+            created_date TIMESTAMP NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS os_rows (
+            row_set_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            os_id,
+            contract_id,
+            motivo INTEGER,
+            tipo INTEGER,
+            closed_at INTEGER,
+            responsavel INTEGER,
+            auxiliares INTEGER,
+            usuario INTEGER,
+            finalizado_por INTEGER,
+            PRIMARY KEY (row_set_id, position),
+            FOREIGN KEY (row_set_id) REFERENCES os_row_sets(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    
+    # Tempo de cada etapa por upload
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_timings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_date TIMESTAMP NOT NULL,
+            filename TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            cache_hit INTEGER NOT NULL,
+            rows INTEGER,
+            total_seconds REAL NOT NULL,
+            stages JSON NOT NULL
+        )
+    ''')
+    
+    # Uploads processados em segundo plano e o andamento de cada um
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_jobs (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            stage TEXT,
+            rows INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            staging_token TEXT,
+            created_date TIMESTAMP NOT NULL,
+            updated_date TIMESTAMP NOT NULL
+        )
+    ''')
+    c.execute('PRAGMA table_info(upload_jobs)')
+    job_columns = {row[1] for row in c.fetchall()}
+    if 'files' not in job_columns:
+        c.execute('ALTER TABLE upload_jobs ADD COLUMN files INTEGER NOT NULL DEFAULT 1')
+    if 'files_done' not in job_columns:
+        c.execute('ALTER TABLE upload_jobs ADD COLUMN files_done INTEGER NOT NULL DEFAULT 0')
+    if 'name_review' not in job_columns:
+        c.execute('ALTER TABLE upload_jobs ADD COLUMN name_review JSON')
+    if 'rule_set_version' not in job_columns:
+        c.execute('ALTER TABLE upload_jobs ADD COLUMN rule_set_version INTEGER')
+    if 'row_set_id' not in job_columns:
+        c.execute('ALTER TABLE upload_jobs ADD COLUMN row_set_id INTEGER')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_upload_jobs_staging ON upload_jobs (staging_token)')
+    # Jobs que estavam na fila ou rodando quando o servidor parou não vão terminar
+    c.execute('''
+        UPDATE upload_jobs SET status = 'error', error = 'Processamento interrompido. Envie o arquivo novamente.'
+        WHERE status IN ('queued', 'running')
+    ''')
     
     conn.commit()
     conn.close()
 
+def insert_summary_rows(c, report_id, summary_data):
+    """
+    Grava o summary_data de um relatório nas tabelas report_technician,
+    report_motivo e report_contract, preservando a ordem original
+    """
+    for tech_position, tech in enumerate(summary_data):
+        c.execute('''
+            INSERT INTO report_technician
+            (report_id, position, technician, technician_key, os_count, total_value)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            report_id,
+            tech_position,
+            tech['Técnico'],
+            tech['Técnico'].lower(),
+            tech['Quantidade de OS'],
+            tech['Valor Total']
+        ))
+        report_technician_id = c.lastrowid
+        for motivo_position, motivo in enumerate(tech['Motivos']):
+            c.execute('''
+                INSERT INTO report_motivo
+                (report_id, report_technician_id, technician_key, position, motivo, quantity, percentage)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                report_id,
+                report_technician_id,
+                tech['Técnico'].lower(),
+                motivo_position,
+                motivo['Motivo'],
+                motivo['Quantidade'],
+                motivo['Porcentagem']
+            ))
+            report_motivo_id = c.lastrowid
+            # Relatórios anteriores às regras de comissão não trazem "Valores": era o valor fixo
+            values = motivo.get('Valores') or [COMMISSION_PER_OS] * len(motivo['Contratos'])
+            c.executemany('''
+                INSERT INTO report_contract (report_id, report_motivo_id, position, contract_id, commission)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (report_id, report_motivo_id, contract_position, str(contract), value)
+                for contract_position, (contract, value) in enumerate(zip(motivo['Contratos'], values))
+            ])
+
+def migrate_report_data(c):
+    """
+    Preenche as tabelas normalizadas a partir do JSON de relatórios antigos e
+    esvazia o JSON, que deixaria de acompanhar as remoções e restaurações
+    """
+    c.execute('''
+        SELECT id, data FROM reports
+        WHERE id NOT IN (SELECT DISTINCT report_id FROM report_technician)
+    ''')
+    for report_id, data in c.fetchall():
+        insert_summary_rows(c, report_id, json.loads(data))
+    c.execute("UPDATE reports SET data = '[]' WHERE data != '[]'")
+
+def refresh_chart_percentages(c, report_id):
+    """
+    Recalcula as porcentagens do gráfico a partir dos totais por motivo
+    """
+    c.execute('SELECT motivo, total FROM report_motivo_totals WHERE report_id = ?', (report_id,))
+    totals = c.fetchall()
+    total_os = sum(total for _, total in totals)
+    c.executemany('''
+        UPDATE report_motivo_totals SET percentage = ?
+        WHERE report_id = ? AND motivo = ?
+    ''', [
+        (round((total / total_os) * 100, 1) if total_os else 0, report_id, motivo)
+        for motivo, total in totals
+    ])
+
+def rebuild_chart_aggregates(c, report_id):
+    """
+    Calcula a distribuição de motivos de um relatório (somando todos os técnicos)
+    e grava em report_motivo_totals
+    """
+    c.execute('DELETE FROM report_motivo_totals WHERE report_id = ?', (report_id,))
+    c.execute('''
+        SELECT motivo, SUM(quantity) FROM report_motivo
+        WHERE report_id = ?
+        GROUP BY motivo
+        ORDER BY MIN(id)
+    ''', (report_id,))
+    c.executemany('''
+        INSERT INTO report_motivo_totals (report_id, motivo, position, total, percentage)
+        VALUES (?, ?, ?, ?, 0)
+    ''', [
+        (report_id, motivo, position, total)
+        for position, (motivo, total) in enumerate(c.fetchall())
+    ])
+    refresh_chart_percentages(c, report_id)
+
+def adjust_chart_total(c, report_id, motivo, delta):
+    """
+    Ajusta o total de um motivo no gráfico após remover/restaurar uma OS
+    """
+    c.execute('''
+        UPDATE report_motivo_totals SET total = total + ?
+        WHERE report_id = ? AND motivo = ?
+    ''', (delta, report_id, motivo))
+    refresh_chart_percentages(c, report_id)
+
+def migrate_chart_aggregates(c):
+    """
+    Calcula o gráfico dos relatórios salvos antes da tabela report_motivo_totals
+    """
+    c.execute('''
+        SELECT id FROM reports
+        WHERE id NOT IN (SELECT DISTINCT report_id FROM report_motivo_totals)
+    ''')
+    for (report_id,) in c.fetchall():
+        rebuild_chart_aggregates(c, report_id)
+
+def get_chart_data(c, report_id):
+    """
+    Lê a distribuição de motivos já calculada, do mais frequente ao menos frequente
+    """
+    c.execute('''
+        SELECT motivo, total, percentage FROM report_motivo_totals
+        WHERE report_id = ?
+        ORDER BY total DESC, position
+    ''', (report_id,))
+    rows = c.fetchall()
+    return {
+        'labels': [motivo for motivo, _, _ in rows],
+        'values': [percentage for _, _, percentage in rows],
+        'counts': [total for _, total, _ in rows],
+    }
+
+def load_summary_data(c, report_id, include_contracts=True):
+    """
+    Remonta o summary_data de um relatório a partir das tabelas normalizadas.
+    Com include_contracts=False traz só a quantidade de contratos de cada motivo
+    ("Total Contratos"), para a página carregar as listas sob demanda.
+    """
+    c.execute('''
+        SELECT id, technician, os_count, total_value FROM report_technician
+        WHERE report_id = ? ORDER BY position
+    ''', (report_id,))
+    technicians = c.fetchall()
+    
+    c.execute('''
+        SELECT id, report_technician_id, motivo, quantity, percentage FROM report_motivo
+        WHERE report_id = ? ORDER BY report_technician_id, position
+    ''', (report_id,))
+    motivos = c.fetchall()
+    
+    if include_contracts:
+        c.execute('''
+            SELECT report_motivo_id, contract_id, commission FROM report_contract
+            WHERE report_id = ? ORDER BY report_motivo_id, position
+        ''', (report_id,))
+        contracts = {}
+        commissions = {}
+        for report_motivo_id, contract_id, commission in c.fetchall():
+            contracts.setdefault(report_motivo_id, []).append(contract_id)
+            commissions.setdefault(report_motivo_id, []).append(commission)
+    else:
+        c.execute('''
+            SELECT report_motivo_id, COUNT(*) FROM report_contract
+            WHERE report_id = ? GROUP BY report_motivo_id
+        ''', (report_id,))
+        contract_totals = dict(c.fetchall())
+    
+    motivos_by_tech = {}
+    for motivo_id, report_technician_id, motivo, quantity, percentage in motivos:
+        motivo_data = {
+            "Motivo": motivo,
+            "Quantidade": quantity,
+            "Porcentagem": percentage,
+        }
+        if include_contracts:
+            motivo_data["Contratos"] = contracts.get(motivo_id, [])
+            motivo_data["Valores"] = commissions.get(motivo_id, [])
+        else:
+            motivo_data["Total Contratos"] = contract_totals.get(motivo_id, 0)
+        motivos_by_tech.setdefault(report_technician_id, []).append(motivo_data)
+    
+    return [
+        {
+            "Técnico": technician,
+            "Quantidade de OS": os_count,
+            "Valor Total": total_value,
+            "Motivos": motivos_by_tech.get(tech_id, [])
+        }
+        for tech_id, technician, os_count, total_value in technicians
+    ]
+
+staged_results = OrderedDict()
+staging_lock = threading.Lock()
+
+def spill_staged_result(token, filename, summary_data, created_at):
+    """
+    Grava no SQLite um resultado que saiu da memória por falta de espaço
+    """
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT OR REPLACE INTO staged_uploads (token, filename, data, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', (token, filename, json.dumps(summary_data), created_at))
+    c.execute('DELETE FROM staged_uploads WHERE created_at < ?', (time.time() - STAGING_TTL_SECONDS,))
+    conn.commit()
+
+def stage_summary(filename, summary_data):
+    """
+    Guarda o resultado de um upload até ser salvo e retorna o token que o identifica.
+    Mantém os mais recentes em memória (LRU) e envia os mais antigos para o SQLite.
+    """
+    token = secrets.token_urlsafe(16)
+    evicted = []
+    with staging_lock:
+        staged_results[token] = (filename, summary_data, time.time())
+        while len(staged_results) > STAGING_MAX_ITEMS:
+            evicted.append(staged_results.popitem(last=False))
+    for old_token, (old_filename, old_summary, created_at) in evicted:
+        if time.time() - created_at < STAGING_TTL_SECONDS:
+            spill_staged_result(old_token, old_filename, old_summary, created_at)
+    return token
+
+def get_staged_summary(token):
+    """
+    Consulta, sem retirar, o resultado associado ao token.
+    Retorna (filename, summary_data) ou None se não existir ou tiver expirado.
+    """
+    with staging_lock:
+        staged = staged_results.get(token)
+        if staged is not None:
+            staged_results.move_to_end(token)
+    if staged is None:
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('SELECT filename, data, created_at FROM staged_uploads WHERE token = ?', (token,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        staged = (row[0], json.loads(row[1]), row[2])
+    
+    filename, summary_data, created_at = staged
+    if time.time() - created_at >= STAGING_TTL_SECONDS:
+        return None
+    return filename, summary_data
+
+def pop_staged_summary(token):
+    """
+    Retira o resultado associado ao token (memória ou SQLite).
+    Retorna (filename, summary_data) ou None se não existir ou tiver expirado.
+    """
+    with staging_lock:
+        staged = staged_results.pop(token, None)
+    if staged is None:
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('SELECT filename, data, created_at FROM staged_uploads WHERE token = ?', (token,))
+        row = c.fetchone()
+        c.execute('DELETE FROM staged_uploads WHERE token = ?', (token,))
+        conn.commit()
+        if row is None:
+            return None
+        staged = (row[0], json.loads(row[1]), row[2])
+    
+    filename, summary_data, created_at = staged
+    if time.time() - created_at >= STAGING_TTL_SECONDS:
+        return None
+    return filename, summary_data
+
+def get_pipeline_version(rule_set_version=None):
+    """
+    Identifica a versão do processamento (lógica de agregação, motivos excluídos,
+    regras de comissão e cadastro de técnicos usado para resolver os auxiliares);
+    qualquer mudança gera uma nova chave de cache. Sem rule_set_version, vale o
+    conjunto de regras ativo
+    """
+    if rule_set_version is None:
+        rule_set_version = get_active_rule_set_version(get_db())
+    rules = json.dumps({
+        'aggregation': AGGREGATION_VERSION,
+        'excluded_motivos': get_motivo_exclusions(get_db()),
+        'commission_rules': rule_set_version,
+        'technician_registry': sync_technician_index(get_db()),
+    }, sort_keys=True)
+    return hashlib.sha256(rules.encode('utf-8')).hexdigest()[:16]
+
+def save_upload(file):
+    """
+    Grava o arquivo enviado calculando o SHA-256 durante a escrita e o guarda
+    com o hash como nome, de modo que arquivos idênticos ocupam um único lugar
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, suffix='.part')
+    with os.fdopen(fd, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    
+    file_hash = digest.hexdigest()
+    extension = os.path.splitext(file.filename)[1].lower() or '.xlsx'
+    file_path = os.path.join(UPLOAD_FOLDER, file_hash + extension)
+    if os.path.exists(file_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, file_path)
+    return file_hash, file_path
+
+def get_cached_summary(file_hash, rule_set_version=None):
+    """
+    Retorna (summary_data, nomes para revisão) já calculados para este arquivo, ou None
+    """
+    pipeline_version = get_pipeline_version(rule_set_version)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT data, name_review FROM upload_cache
+        WHERE file_hash = ? AND pipeline_version = ?
+    ''', (file_hash, pipeline_version))
+    row = c.fetchone()
+    if row is None:
+        return None
+    c.execute('''
+        UPDATE upload_cache SET last_used = ? WHERE file_hash = ? AND pipeline_version = ?
+    ''', (time.time(), file_hash, pipeline_version))
+    conn.commit()
+    return json.loads(row[0]), json.loads(row[1] or '[]')
+
+def store_cached_summary(file_hash, summary_data, name_review=(), rule_set_version=None):
+    """
+    Guarda o summary_data calculado para este arquivo e os nomes para revisão.
+    Cada arquivo tem uma entrada por versão do processamento; passando de
+    UPLOAD_CACHE_MAX_ITEMS, as usadas há mais tempo são apagadas
+    """
+    pipeline_version = get_pipeline_version(rule_set_version)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT OR REPLACE INTO upload_cache (file_hash, pipeline_version, data, name_review, created_date, last_used)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (
+        file_hash,
+        pipeline_version,
+        json.dumps(summary_data),
+        json.dumps(list(name_review)),
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        time.time()
+    ))
+    c.execute('''
+        DELETE FROM upload_cache WHERE rowid IN (
+            SELECT rowid FROM upload_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+        )
+    ''', (UPLOAD_CACHE_MAX_ITEMS,))
+    conn.commit()
+
+def find_cached_upload(conn, file_hash, rule_set_version):
+    """
+    Resultado já calculado para o arquivo (ou conjunto de arquivos) com estas regras,
+    desde que as OS de origem continuem guardadas para o relatório:
+    (summary_data, nomes para revisão, row_set_id) ou None
+    """
+    cached = get_cached_summary(file_hash, rule_set_version)
+    row_set_id = find_os_row_set(conn, file_hash) if cached is not None else None
+    if row_set_id is None:
+        return None
+    return cached[0], cached[1], row_set_id
+
+# Índice em memória do cadastro: (tipo, apelido) -> nomes completos possíveis.
+# Carregado na inicialização e atualizado de forma incremental pelo id dos apelidos.
+technician_index = {}
+technician_index_version = 0
+technician_lock = threading.Lock()
+
+def insert_technicians(c, names, logins=()):
+    """
+    Cadastra os técnicos (nomes completos normalizados) com seus apelidos e os
+    logins associados; nada é sobrescrito, apenas acrescentado
+    """
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    c.executemany('''
+        INSERT INTO technicians (name, first_seen, last_seen) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET last_seen = excluded.last_seen
+    ''', [(name, now, now) for name in names])
+    insert_technician_aliases(c, names, logins)
+
+def insert_technician_aliases(c, names, logins=()):
+    """
+    Grava os apelidos (sem acentos) de técnicos já cadastrados: o nome completo,
+    o primeiro nome, as demais partes do nome e os logins
+    """
+    aliases = []
+    for name in names:
+        parts = fold_name(name).split()
+        aliases.append((' '.join(parts), 'name', name))
+        aliases.append((parts[0], 'first_name', name))
+        aliases.extend((part, 'name_part', name) for part in parts[1:])
+    aliases.extend((fold_name(login), 'login', name) for login, name in logins)
+    c.executemany('''
+        INSERT OR IGNORE INTO technician_aliases (technician_id, alias, kind)
+        SELECT id, ?, ? FROM technicians WHERE name = ?
+    ''', aliases)
+
+def migrate_technician_registry(c):
+    """
+    Inicia o cadastro com os responsáveis dos relatórios já salvos (as chaves com
+    mais de uma palavra; auxiliares sem correspondência ficam só com o primeiro nome)
+    """
+    c.execute('SELECT 1 FROM technicians LIMIT 1')
+    if not c.fetchone():
+        c.execute('SELECT DISTINCT technician_key FROM report_technician')
+        names = [row[0] for row in c.fetchall() if len(row[0].split()) > 1]
+        insert_technicians(c, names)
+    
+    # Cadastros anteriores à comparação sem acentos não têm o apelido do nome completo
+    c.execute("SELECT 1 FROM technician_aliases WHERE kind = 'name' LIMIT 1")
+    if not c.fetchone():
+        c.execute('SELECT name FROM technicians')
+        insert_technician_aliases(c, [row[0] for row in c.fetchall()])
+
+def sync_technician_index(conn):
+    """
+    Traz para o índice em memória os apelidos gravados desde a última leitura
+    (inclusive por outros processos) e retorna a versão do cadastro
+    """
+    global technician_index_version
+    with technician_lock:
+        rows = conn.execute('''
+            SELECT a.id, a.kind, a.alias, t.name
+            FROM technician_aliases a
+            JOIN technicians t ON t.id = a.technician_id
+            WHERE a.id > ?
+            ORDER BY a.id
+        ''', (technician_index_version,)).fetchall()
+        for alias_id, kind, alias, name in rows:
+            technician_index.setdefault((kind, fold_name(alias)), set()).add(name)
+            technician_index_version = alias_id
+        return technician_index_version
+
+def technician_index_snapshot(conn):
+    """
+    Cópia do índice em memória, sincronizado antes com o banco
+    """
+    sync_technician_index(conn)
+    with technician_lock:
+        return {key: frozenset(names) for key, names in technician_index.items()}
+
+def register_technicians(conn, df_cleaned):
+    """
+    Acrescenta ao cadastro os responsáveis (com as grafias já unificadas) e logins
+    de um upload e devolve o índice atualizado para resolver os auxiliares
+    """
+    responsible_names = canonical_responsible_names(df_cleaned, technician_index_snapshot(conn))
+    insert_technicians(conn.cursor(), sorted(set(responsible_names)),
+                       learn_login_aliases(df_cleaned, responsible_names))
+    conn.commit()
+    return technician_index_snapshot(conn)
+
+def get_technician_collisions():
+    """
+    Primeiros nomes e logins que levam a mais de um técnico
+    """
+    with technician_lock:
+        return {
+            alias: sorted(names)
+            for (kind, alias), names in technician_index.items()
+            if kind != 'name_part' and len(names) > 1
+        }
+
+# Campos de uma regra de comissão que restringem a quais OS ela se aplica
+COMMISSION_RULE_FIELDS = ('motivo', 'tipo', 'role')
+COMMISSION_ROLES = ('responsavel', 'auxiliar')
+
+# Regras compiladas por versão; as versões nunca mudam depois de criadas
+compiled_rule_sets = {}
+
+def compile_commission_rules(rows):
+    """
+    Prepara as regras para aplicação em lote: datas convertidas, ordem de
+    prioridade da mais específica (mais campos preenchidos) para a mais genérica
+    (no empate vale a cadastrada por último) e índice por (motivo, tipo, papel),
+    com None nos campos que a regra deixa livres. As regras aplicáveis a cada
+    combinação são montadas na primeira vez que ela aparece e guardadas em
+    'candidates', que vive junto com a versão compilada
+    """
+    rules = []
+    for row in rows:
+        rule = {field: row[field] for field in COMMISSION_RULE_FIELDS}
+        rule['id'] = row['id']
+        rule['rate'] = float(row['rate'])
+        rule['valid_from'] = pd.Timestamp(row['valid_from']) if row['valid_from'] else None
+        rule['valid_to'] = pd.Timestamp(row['valid_to']) if row['valid_to'] else None
+        rule['specificity'] = (sum(rule[field] is not None for field in COMMISSION_RULE_FIELDS)
+                               + (rule['valid_from'] is not None or rule['valid_to'] is not None))
+        rules.append(rule)
+    rules.sort(key=lambda rule: (rule['specificity'], rule['id']), reverse=True)
+    by_key = {}
+    for rule in rules:
+        by_key.setdefault(tuple(rule[field] for field in COMMISSION_RULE_FIELDS), []).append(rule)
+    has_periods = any(rule['valid_from'] is not None or rule['valid_to'] is not None for rule in rules)
+    return {'rules': rules, 'by_key': by_key, 'has_periods': has_periods, 'candidates': {}}
+
+def commission_rate(rule_set, motivo, tipo, role, date):
+    """
+    Valor da primeira regra da versão compilada que vale para a combinação;
+    zero quando nenhuma vale. Regras com período não valem sem data (NaT)
+    """
+    key = (motivo, tipo, role)
+    candidates = rule_set['candidates'].get(key)
+    if candidates is None:
+        patterns = {(m, t, r) for m in (motivo, None) for t in (tipo, None) for r in (role, None)}
+        candidates = sorted((rule for pattern in patterns for rule in rule_set['by_key'].get(pattern, ())),
+                            key=lambda rule: (rule['specificity'], rule['id']), reverse=True)
+        rule_set['candidates'][key] = candidates
+    for rule in candidates:
+        if rule['valid_from'] is not None and not date >= rule['valid_from']:
+            continue
+        if rule['valid_to'] is not None and not date <= rule['valid_to']:
+            continue
+        return rule['rate']
+    return 0.0
+
+def get_active_rule_set_version(conn):
+    """
+    Versão mais recente das regras de comissão, usada nos novos uploads
+    """
+    c = conn.cursor()
+    c.execute('SELECT MAX(version) FROM commission_rule_sets')
+    return c.fetchone()[0]
+
+def load_commission_rules(conn, version):
+    """
+    Regras compiladas de uma versão (lidas do banco uma vez por versão)
+    """
+    rules = compiled_rule_sets.get(version)
+    if rules is None:
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, motivo, tipo, role, valid_from, valid_to, rate FROM commission_rules
+            WHERE rule_set_version = ?
+        ''', (version,))
+        rules = compile_commission_rules(c.fetchall())
+        compiled_rule_sets[version] = rules
+    return rules
+
+def parse_commission_rules(payload):
+    """
+    Valida as regras enviadas para /commission_rules e devolve (descrição, regras);
+    levanta ValueError com a mensagem para o usuário
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('rules'), list) or not payload['rules']:
+        raise ValueError('Informe a lista de regras')
+    rules = []
+    for number, item in enumerate(payload['rules'], start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f'Regra {number}: formato inválido')
+        rule = {}
+        for field in ('motivo', 'tipo', 'role', 'valid_from', 'valid_to'):
+            value = item.get(field)
+            rule[field] = (str(value).strip() or None) if value is not None else None
+        if rule['role'] is not None and rule['role'] not in COMMISSION_ROLES:
+            raise ValueError(f'Regra {number}: papel deve ser "responsavel" ou "auxiliar"')
+        for field in ('valid_from', 'valid_to'):
+            if rule[field] is not None:
+                try:
+                    datetime.strptime(rule[field], '%Y-%m-%d')
+                except ValueError:
+                    raise ValueError(f'Regra {number}: data inválida em {field} (use AAAA-MM-DD)')
+        if rule['valid_from'] and rule['valid_to'] and rule['valid_from'] > rule['valid_to']:
+            raise ValueError(f'Regra {number}: valid_from posterior a valid_to')
+        try:
+            rule['rate'] = float(item.get('rate'))
+        except (TypeError, ValueError):
+            raise ValueError(f'Regra {number}: valor (rate) inválido')
+        if not rule['rate'] >= 0:
+            raise ValueError(f'Regra {number}: valor (rate) não pode ser negativo')
+        rules.append(rule)
+    description = str(payload.get('description') or '').strip() or None
+    return description, rules
+
+def create_commission_rule_set(conn, description, rules):
+    """
+    Grava um novo conjunto de regras, que passa a ser o ativo, e devolve a versão
+    """
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO commission_rule_sets (created_date, description) VALUES (?, ?)
+    ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), description))
+    version = c.lastrowid
+    c.executemany('''
+        INSERT INTO commission_rules (rule_set_version, motivo, tipo, role, valid_from, valid_to, rate)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (version, rule['motivo'], rule['tipo'], rule['role'], rule['valid_from'], rule['valid_to'], rule['rate'])
+        for rule in rules
+    ])
+    conn.commit()
+    return version
+
+# Exclusões de motivo compiladas, pela lista (tipo, padrão) que as gerou
+compiled_motivo_exclusions = {}
+
+def get_motivo_exclusions(conn):
+    """
+    Exclusões cadastradas como tuplas (tipo, padrão), em ordem estável
+    """
+    c = conn.cursor()
+    c.execute('SELECT kind, pattern FROM motivo_exclusions ORDER BY kind, pattern')
+    return tuple((kind, pattern) for kind, pattern in c.fetchall())
+
+def load_motivo_exclusions(conn):
+    """
+    Exclusões vigentes já compiladas; só recompila quando o cadastro muda
+    """
+    exclusions = get_motivo_exclusions(conn)
+    compiled = compiled_motivo_exclusions.get(exclusions)
+    if compiled is None:
+        compiled = compile_motivo_exclusions(exclusions)
+        compiled_motivo_exclusions.clear()
+        compiled_motivo_exclusions[exclusions] = compiled
+    return compiled
+
+def parse_motivo_exclusion(payload):
+    """
+    Valida uma exclusão enviada para /motivo_exclusions e devolve (tipo, padrão);
+    levanta ValueError com a mensagem para o usuário
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('Informe o tipo e o padrão')
+    kind = payload.get('kind')
+    if kind not in MOTIVO_EXCLUSION_KINDS:
+        raise ValueError('Tipo deve ser "exact", "prefix" ou "regex"')
+    pattern = str(payload.get('pattern') or '').strip()
+    if not pattern:
+        raise ValueError('Informe o padrão')
+    if kind == 'regex':
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f'Expressão regular inválida: {e}')
+    return kind, pattern
+
+# Colunas de os_rows guardadas como códigos do dicionário os_values
+OS_ROW_CODED_COLUMNS = {
+    'motivo': 'Motivo',
+    'tipo': 'Tipo',
+    'responsavel': 'Responsável',
+    'auxiliares': 'Técnico(s) auxiliar(s)',
+    'usuario': 'Usuário',
+    'finalizado_por': 'Finalizado Por',
+}
+
+def sql_values(series):
+    """
+    Valores da coluna prontos para o sqlite3 (vazios como None)
+    """
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def encode_os_values(c, values):
+    """
+    Código em os_values de cada valor da coluna, cadastrando os textos novos;
+    cada texto distinto é consultado uma vez
+    """
+    text = values.astype('string')
+    distinct = text.dropna().unique().tolist()
+    c.executemany('INSERT OR IGNORE INTO os_values (value) VALUES (?)', [(value,) for value in distinct])
+    codes = {}
+    for start in range(0, len(distinct), SQL_IN_CHUNK):
+        chunk = distinct[start:start + SQL_IN_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f'SELECT value, id FROM os_values WHERE value IN ({placeholders})', chunk)
+        codes.update(c.fetchall())
+    return text.map(codes).astype('Int64')
+
+def find_os_row_set(conn, file_hash):
+    """
+    Conjunto de OS já guardado para este arquivo, ou None
+    """
+    c = conn.cursor()
+    c.execute('SELECT id FROM os_row_sets WHERE file_hash = ?', (file_hash,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    c.execute('UPDATE os_row_sets SET last_used = ? WHERE id = ?', (time.time(), row[0]))
+    conn.commit()
+    return row[0]
+
+def store_os_rows(conn, file_hash, df_os):
+    """
+    Guarda as OS lidas do arquivo, sem aplicar as exclusões de motivo (o cálculo as
+    aplica a cada vez), e devolve o id do conjunto. Conjuntos que nenhum relatório
+    salvo usa são apagados depois que o resultado do upload expira, junto com os
+    textos de os_values que só eles usavam.
+    """
+    c = conn.cursor()
+    c.execute('''
+        DELETE FROM os_row_sets
+        WHERE last_used < ? AND id NOT IN (SELECT row_set_id FROM reports WHERE row_set_id IS NOT NULL)
+    ''', (time.time() - 2 * STAGING_TTL_SECONDS,))
+    if c.rowcount > 0:
+        # NOT IN com NULL na lista não apagaria nada: considerar só os códigos preenchidos
+        c.execute(f'''
+            DELETE FROM os_values WHERE id NOT IN (
+                {' UNION '.join(f'SELECT {column} FROM os_rows WHERE {column} IS NOT NULL'
+                                for column in OS_ROW_CODED_COLUMNS)}
+            )
+        ''')
+    c.execute('''
+        INSERT OR IGNORE INTO os_row_sets (file_hash, rows, created_date, last_used)
+        VALUES (?, ?, ?, ?)
+    ''', (file_hash, len(df_os), datetime.now().strftime('%Y-%m-%d %H:%M:%S'), time.time()))
+    if c.rowcount == 0:
+        # Outro job guardou o mesmo arquivo enquanto este processava
+        conn.commit()
+        return find_os_row_set(conn, file_hash)
+    row_set_id = c.lastrowid
+    
+    df_os = df_os.reset_index(drop=True)
+    closed_at = os_closing_times(df_os)
+    columns = [
+        [row_set_id] * len(df_os),
+        list(range(len(df_os))),
+        sql_values(df_os['ID']),
+        sql_values(df_os['ID Contrato']),
+    ]
+    for column, source in OS_ROW_CODED_COLUMNS.items():
+        values = df_os[source] if source in df_os.columns else pd.Series(None, index=df_os.index)
+        columns.append(sql_values(encode_os_values(c, values)))
+    # Encerramento em segundos desde 1970 (inteiro, bem menor que o texto da data)
+    columns.append(sql_values(((closed_at - pd.Timestamp(0)) // pd.Timedelta(seconds=1)).astype('Int64')))
+    c.executemany(f'''
+        INSERT INTO os_rows (row_set_id, position, os_id, contract_id, {', '.join(OS_ROW_CODED_COLUMNS)}, closed_at)
+        VALUES ({','.join('?' * (len(columns)))})
+    ''', zip(*columns))
+    conn.commit()
+    return row_set_id
+
+def load_os_rows(conn, row_set_id):
+    """
+    Remonta as OS guardadas com as mesmas colunas da leitura da planilha
+    """
+    rows = pd.read_sql_query(f'''
+        SELECT os_id, contract_id, {', '.join(OS_ROW_CODED_COLUMNS)}, closed_at
+        FROM os_rows WHERE row_set_id = ? ORDER BY position
+    ''', conn, params=(row_set_id,))
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT id, value FROM os_values WHERE id IN (
+            {' UNION '.join(f'SELECT {column} FROM os_rows WHERE row_set_id = ?' for column in OS_ROW_CODED_COLUMNS)}
+        )
+    ''', (row_set_id,) * len(OS_ROW_CODED_COLUMNS))
+    values = dict(c.fetchall())
+    
+    df = pd.DataFrame({'ID': rows['os_id'].astype(object), 'ID Contrato': rows['contract_id'].astype(object)})
+    for column, source in OS_ROW_CODED_COLUMNS.items():
+        df[source] = rows[column].map(values).astype(object)
+    df['Encerrada'] = pd.to_datetime(rows['closed_at'], unit='s')
+    df = type_id_columns(df)
+    return df[OS_PIPELINE_COLUMNS + OS_OPTIONAL_COLUMNS]
+
 html_template = """
 <!DOCTYPE html>
 <html>
@@ -301,8 +1558,8 @@ html_template = """
 
         <div class="upload-form">
             <form action="/upload" method="post" enctype="multipart/form-data">
-                <input type="file" name="file" required class="file-input" id="file-input">
-                <label for="file-input" class="file-label">Escolher arquivo Excel</label>
+                <input type="file" name="file" multiple required class="file-input" id="file-input">
+                <label for="file-input" class="file-label">Escolher arquivos Excel</label>
                 <button type="submit">Processar arquivo</button>
             </form>
             <div style="margin-top: 20px">
@@ -310,10 +1567,34 @@ html_template = """
             </div>
         </div>
 
+        {% if job %}
+            <div class="info" id="jobStatus" data-status-url="{{ url_for('upload_job_status', job_id=job.id) }}">
+                Processando <strong>{{ job.filename }}</strong>: <span id="jobProgress">aguardando na fila</span>
+            </div>
+        {% endif %}
+
         {% if summary_data %}
             <div class="info">
                 Total de técnicos: <strong>{{ summary_data|length }}</strong>
             </div>
+            {% if name_review %}
+                <div class="info">
+                    <strong>Nomes de auxiliares para revisão</strong>
+                    <ul>
+                        {% for item in name_review %}
+                            <li>
+                                {% if item.tecnico %}
+                                    "{{ item.auxiliar }}" foi atribuído a {{ item.tecnico|title }}
+                                    (diferença de {{ item.distancia }} letra{{ 's' if item.distancia > 1 }})
+                                {% else %}
+                                    "{{ item.auxiliar }}" pode ser {{ item.candidatos|map('title')|join(' ou ') }}; mantido como está
+                                {% endif %}
+                                - {{ item.ocorrencias }} OS
+                            </li>
+                        {% endfor %}
+                    </ul>
+                </div>
+            {% endif %}
             <table>
                 <tr>
                     <th>Técnico</th>
@@ -322,10 +1603,10 @@ html_template = """
                     <th>Detalhes</th>
                 </tr>
                 {% for row in summary_data %}
-                <tr>
+                <tr class="technician-row" data-technician="{{ row['Técnico']|lower }}" data-name="{{ row['Técnico'] }}">
                     <td>{{ row["Técnico"] }}</td>
-                    <td class="value-highlight">{{ row["Quantidade de OS"] }}</td>
-                    <td class="value-highlight">R$ {{ "%.2f"|format(row["Valor Total"]) }}</td>
+                    <td class="value-highlight os-count">{{ row["Quantidade de OS"] }}</td>
+                    <td class="value-highlight total-value">R$ {{ "%.2f"|format(row["Valor Total"]) }}</td>
                     <td>
                         <button class="accordion">Ver detalhes</button>
                         <div class="panel">
@@ -336,42 +1617,16 @@ html_template = """
                                     <th>Porcentagem</th>
                                     <th>Contratos</th>
                                 </tr>
+                                {# Uma linha curta por motivo: o painel de contratos (lista, "Carregar mais" e
+                                   OS removidas) é montado no JS e preenchido via contracts_url na primeira abertura #}
                                 {% for motivo in row["Motivos"] %}
                                 <tr>
                                     <td>{{ motivo["Motivo"] }}</td>
-                                    <td>{{ motivo["Quantidade"] }}</td>
+                                    <td class="motivo-quantity">{{ motivo["Quantidade"] }}</td>
                                     <td>{{ motivo["Porcentagem"] }}%</td>
-                                    <td>
-                                        {% if motivo["Contratos"] %}
-                                        <button class="contract-btn" onclick="toggleContracts(this)">
-                                            Ver Contratos ({{ motivo["Contratos"]|length }})
-                                        </button>
-                                        <!-- Update the contracts-panel div in the HTML template -->
-<div class="contracts-panel" style="display: none;">
-    <div class="contracts-container">
-        {% for contract in motivo["Contratos"] %}
-        <div class="contract-item">
-            <span>{{ contract }}</span>
-            <button class="edit-btn" 
-                    onclick="openEditModal('{{ contract }}', '{{ row['Técnico'] }}', '{{ motivo['Motivo'] }}', '{{ report_id }}')">
-                Remover da Comissão
-            </button>
-        </div>
-        {% endfor %}
-    </div>
-    
-    <div class="removed-os-section" style="margin-top: 15px;">
-        <h4>OS Removidas da Comissão:</h4>
-        <div class="removed-os-list" data-technician="{{ row['Técnico'] }}" data-motivo="{{ motivo['Motivo'] }}">
-            <!-- Removed OS will be loaded here -->
-        </div>
-    </div>
-</div>
-
-                                        {% else %}
-                                        Sem contratos
-                                        {% endif %}
-                                    </td>
+                                    <td>{% if motivo["Total Contratos"] -%}
+                                        <button class="contract-btn" data-motivo="{{ motivo['Motivo'] }}" data-total="{{ motivo['Total Contratos'] }}">Ver Contratos ({{ motivo["Total Contratos"] }})</button>
+                                        {%- else %}Sem contratos{% endif %}</td>
                                 </tr>
                                 {% endfor %}
                             </table>
@@ -383,8 +1638,7 @@ html_template = """
         {% endif %}
         {% if summary_data %}
             <form action="{{ url_for('save_report') }}" method="post" style="text-align: center;">
-                <input type="hidden" name="filename" value="{{ filename }}">
-                <input type="hidden" name="report_data" value="{{ report_data }}">
+                <input type="hidden" name="staging_token" value="{{ staging_token }}">
                 <button type="submit" class="save-btn">Salvar Relatório</button>
             </form>
         {% endif %}
@@ -425,9 +1679,9 @@ html_template = """
     <script>
         // Update file input label
         document.getElementById('file-input').addEventListener('change', function(e) {
-            const fileName = e.target.files[0].name;
+            const files = e.target.files;
             const label = document.querySelector('.file-label');
-            label.textContent = fileName;
+            label.textContent = files.length > 1 ? `${files.length} arquivos selecionados` : files[0].name;
         });
 
         // Accordion functionality
@@ -444,32 +1698,106 @@ html_template = """
             });
         }
 
+        const contractsUrl = {{ (contracts_url or '')|tojson }};
+        const currentReportId = {{ (report_id or '')|tojson }};
+
+        // Fetch the next page of contracts for one technician/motivo panel
+        function loadContracts(panel) {
+            const accordionPanel = panel.closest('.panel');
+            const params = new URLSearchParams({
+                technician: panel.dataset.technician,
+                motivo: panel.dataset.motivo,
+                offset: panel.querySelectorAll('.contract-item').length
+            });
+            
+            return fetch(`${contractsUrl}?${params}`)
+                .then(response => response.json())
+                .then(data => {
+                    const container = panel.querySelector('.contracts-container');
+                    data.contracts.forEach(contract => {
+                        const item = document.createElement('div');
+                        item.className = 'contract-item';
+                        const label = document.createElement('span');
+                        label.textContent = contract;
+                        item.appendChild(label);
+                        if (currentReportId) {
+                            const removeButton = document.createElement('button');
+                            removeButton.className = 'edit-btn';
+                            removeButton.textContent = 'Remover da Comissão';
+                            removeButton.onclick = () => openEditModal(
+                                item, contract, panel.dataset.technician, panel.dataset.motivo, currentReportId);
+                            item.appendChild(removeButton);
+                        }
+                        container.appendChild(item);
+                    });
+                    panel.querySelector('.load-more-btn').style.display = data.has_more ? 'inline-block' : 'none';
+                    accordionPanel.style.maxHeight = accordionPanel.scrollHeight + "px";
+                });
+        }
+
+        // Contracts panel of one technician/motivo, built the first time it is opened
+        function buildContractsPanel(button) {
+            const panel = document.createElement('div');
+            panel.className = 'contracts-panel';
+            panel.dataset.technician = button.closest('.technician-row').dataset.name;
+            panel.dataset.motivo = button.dataset.motivo;
+            panel.innerHTML = `
+                <div class="contracts-container"></div>
+                <button type="button" class="contract-btn load-more-btn" style="display: none;">
+                    Carregar mais
+                </button>`;
+            panel.querySelector('.load-more-btn').onclick = () => loadContracts(panel);
+            
+            if (currentReportId) {
+                const section = document.createElement('div');
+                section.className = 'removed-os-section';
+                section.style.marginTop = '15px';
+                section.innerHTML = '<h4>OS Removidas da Comissão:</h4><div class="removed-os-list"></div>';
+                panel.appendChild(section);
+                loadRemovedOS().then(removed => {
+                    const byMotivo = removed[panel.dataset.technician.toLowerCase()] || {};
+                    renderRemovedOS(section.querySelector('.removed-os-list'), byMotivo[panel.dataset.motivo] || []);
+                });
+            }
+            button.after(panel);
+            return panel;
+        }
+
         // Toggle contracts panel
         function toggleContracts(button) {
-            const panel = button.nextElementSibling;
+            let panel = button.nextElementSibling;
             const accordionPanel = button.closest('.panel');
             
-            if (panel.style.display === "none") {
+            if (!panel) {
+                panel = buildContractsPanel(button);
+                loadContracts(panel);
+                button.textContent = "Ocultar Contratos";
+            } else if (panel.style.display === "none") {
                 panel.style.display = "block";
                 button.textContent = "Ocultar Contratos";
-                
-                // Update accordion panel height to show all content
-                setTimeout(() => {
-                    accordionPanel.style.maxHeight = accordionPanel.scrollHeight + "px";
-                }, 10);
             } else {
                 panel.style.display = "none";
-                button.textContent = "Ver Contratos (" + 
-                    (panel.querySelectorAll('.contract-item').length) + ")";
-                    
-                // Update accordion panel height after hiding contracts
-                setTimeout(() => {
-                    accordionPanel.style.maxHeight = accordionPanel.scrollHeight + "px";
-                }, 10);
+                button.textContent = "Ver Contratos (" + button.dataset.total + ")";
             }
+            
+            // Update accordion panel height after showing or hiding contracts
+            setTimeout(() => {
+                accordionPanel.style.maxHeight = accordionPanel.scrollHeight + "px";
+            }, 10);
         }
 
-        function openEditModal(contractId, technician, motivo, reportId) {
+        document.addEventListener('click', function(e) {
+            const button = e.target.closest('.contract-btn[data-motivo]');
+            if (button) {
+                toggleContracts(button);
+            }
+        });
+
+        // Contract item being removed; updated in place once the server confirms
+        let pendingContractItem = null;
+
+        function openEditModal(contractItem, contractId, technician, motivo, reportId) {
+            pendingContractItem = contractItem;
             const modal = document.getElementById('editModal');
             document.getElementById('contractId').value = contractId;
             document.getElementById('technicianName').value = technician;
@@ -483,60 +1811,157 @@ html_template = """
             modal.style.display = 'block';
         }
 
-        document.querySelector('.close').onclick = function() {
+        function closeEditModal() {
             document.getElementById('editModal').style.display = 'none';
+            document.getElementById('removeOsForm').reset();
+            pendingContractItem = null;
         }
 
-        document.querySelector('.cancel-btn').onclick = function() {
-            document.getElementById('editModal').style.display = 'none';
+        document.querySelector('.close').onclick = closeEditModal;
+        document.querySelector('.cancel-btn').onclick = closeEditModal;
+
+        // Technician totals returned by the batch endpoints
+        function updateTechnicianTotals(technicians) {
+            technicians.forEach(tech => {
+                const row = document.querySelector(
+                    `.technician-row[data-technician="${CSS.escape(tech['Técnico'].toLowerCase())}"]`);
+                if (row) {
+                    row.querySelector('.os-count').textContent = tech['Quantidade de OS'];
+                    row.querySelector('.total-value').textContent = 'R$ ' + tech['Valor Total'].toFixed(2);
+                }
+            });
+        }
+
+        function removedOsItem(os) {
+            const item = document.createElement('div');
+            item.className = 'removed-os-item';
+            [['Contrato', os.contract_id], ['Motivo da Remoção', os.removal_reason], ['Data', os.removed_date]]
+                .forEach(([label, value], index) => {
+                    if (index) {
+                        item.appendChild(document.createElement('br'));
+                    }
+                    const strong = document.createElement('strong');
+                    strong.textContent = label + ':';
+                    item.append(strong, ' ' + value);
+                });
+            return item;
+        }
+
+        function renderRemovedOS(section, removed) {
+            section.replaceChildren(...removed.map(removedOsItem));
+            if (!removed.length) {
+                const empty = document.createElement('p');
+                empty.textContent = 'Nenhuma OS removida';
+                section.appendChild(empty);
+            }
+        }
+
+        function currentTimestamp() {
+            const now = new Date();
+            const pad = value => String(value).padStart(2, '0');
+            return `${now.getFullYear()}-${pad(now.getMonth() + 1)}-${pad(now.getDate())} ` +
+                   `${pad(now.getHours())}:${pad(now.getMinutes())}:${pad(now.getSeconds())}`;
+        }
+
+        // Take the removed contract out of its panel and move it to the removed list
+        function markContractRemoved(contractItem, removed) {
+            const panel = contractItem.closest('.contracts-panel');
+            const button = panel.previousElementSibling;
+            const quantity = button.closest('tr').querySelector('.motivo-quantity');
+            quantity.textContent = Number(quantity.textContent) - 1;
+            button.dataset.total = Number(button.dataset.total) - 1;
+            contractItem.remove();
+
+            // Only after the panel's removed list was rendered from the server, so it is not overwritten
+            loadRemovedOS().then(() => {
+                const section = panel.querySelector('.removed-os-list');
+                section.querySelector('p')?.remove();
+                section.prepend(removedOsItem(removed));
+                const accordionPanel = button.closest('.panel');
+                accordionPanel.style.maxHeight = accordionPanel.scrollHeight + "px";
+            });
         }
 
         document.getElementById('removeOsForm').onsubmit = function(e) {
             e.preventDefault();
-            const formData = new FormData(this);
+            const contractItem = pendingContractItem;
+            const item = {
+                contract_id: this.contract_id.value,
+                technician: this.technician.value,
+                motivo: this.motivo.value,
+                removal_reason: this.removal_reason.value
+            };
             
-            fetch('/remove_os', {
+            fetch('/remove_os/batch', {
                 method: 'POST',
-                body: formData
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({report_id: this.report_id.value, items: [item]})
             })
             .then(response => response.json())
             .then(data => {
-                if (data.success) {
-                    location.reload();
-                } else {
+                if (!data.success) {
                     alert('Erro ao remover OS: ' + data.error);
+                    return;
                 }
+                if (data.applied[0]) {
+                    markContractRemoved(contractItem, {...item, removed_date: currentTimestamp()});
+                }
+                updateTechnicianTotals(data.technicians);
+                closeEditModal();
             });
         }
 
-        // Load removed OS for each section
+        // Removed OS of the report, grouped by technician (lowercase) and motivo on the
+        // server; fetched once, when the first contracts panel is opened
+        let removedOS = null;
+
         function loadRemovedOS() {
-            const reportId = document.querySelector('input[name="report_id"]').value;
-            fetch(`/get_removed_os/${reportId}`)
+            if (!removedOS) {
+                removedOS = fetch(`/get_removed_os/${currentReportId}?grouped=1`)
+                    .then(response => response.json());
+            }
+            return removedOS;
+        }
+
+        // Follow a background upload until its result is ready
+        const uploadStages = {
+            cache_lookup: 'verificando arquivo',
+            parse: 'lendo planilha',
+            store_rows: 'guardando OS',
+            load_rows: 'carregando OS salvas',
+            name_mapping: 'identificando técnicos',
+            commission: 'aplicando regras de comissão',
+            aggregate: 'totalizando por técnico'
+        };
+
+        function pollUploadJob() {
+            const box = document.getElementById('jobStatus');
+            if (!box) {
+                return;
+            }
+            fetch(box.dataset.statusUrl)
                 .then(response => response.json())
-                .then(data => {
-                    const sections = document.querySelectorAll('.removed-os-list');
-                    sections.forEach(section => {
-                        const technician = section.dataset.technician;
-                        const motivo = section.dataset.motivo;
-                        const filteredOS = data.filter(os => 
-                            os.technician.toLowerCase() === technician.toLowerCase() && 
-                            os.motivo === motivo
-                        );
-                        
-                        section.innerHTML = filteredOS.map(os => `
-                            <div class="removed-os-item">
-                                <strong>Contrato:</strong> ${os.contract_id}<br>
-                                <strong>Motivo da Remoção:</strong> ${os.removal_reason}<br>
-                                <strong>Data:</strong> ${os.removed_date}
-                            </div>
-                        `).join('') || '<p>Nenhuma OS removida</p>';
-                    });
+                .then(job => {
+                    const progress = document.getElementById('jobProgress');
+                    if (job.status === 'done') {
+                        location.href = job.result_url;
+                    } else if (job.status === 'error') {
+                        progress.textContent = 'erro: ' + job.error;
+                    } else {
+                        let text = job.status === 'queued' ? 'aguardando na fila' : (uploadStages[job.stage] || job.stage);
+                        if (job.files > 1 && job.stage === 'parse') {
+                            text += `: ${job.files_done} de ${job.files} arquivos`;
+                        }
+                        if (job.rows) {
+                            text += ` (${job.rows} linhas lidas)`;
+                        }
+                        progress.textContent = text;
+                        setTimeout(pollUploadJob, 1000);
+                    }
                 });
         }
 
-        // Call when page loads
-        document.addEventListener('DOMContentLoaded', loadRemovedOS);
+        document.addEventListener('DOMContentLoaded', pollUploadJob);
     </script>
 </body>
 </html>
@@ -691,11 +2116,20 @@ reports_template = """
                         <div class="report-info">
                             <div class="report-title">{{ report.filename }}</div>
                             <div class="report-date">Data: {{ report.date }}</div>
+                            <div class="report-date">
+                                {{ report.technician_count }} técnicos · {{ report.os_count }} OS ·
+                                R$ {{ "%.2f"|format(report.total_value) }}
+                            </div>
                         </div>
                         <div class="report-actions">
     <a href="{{ url_for('view_report', report_id=report.id) }}" class="view-btn">Ver Relatório</a>
     <a href="{{ url_for('view_chart', report_id=report.id) }}" class="view-btn">Ver Gráfico</a>
     <a href="{{ url_for('view_removed_os', report_id=report.id) }}" class="view-btn">OS Removidas</a>
+    {% if report.row_set_id %}
+    <form action="{{ url_for('recompute_report', report_id=report.id) }}" method="post" style="display: inline;">
+        <button type="submit" class="view-btn" title="Recalcula com as regras e o cadastro de técnicos atuais">Recalcular</button>
+    </form>
+    {% endif %}
     <form action="{{ url_for('delete_report', report_id=report.id) }}" method="post" style="display: inline;">
         <button type="submit" class="delete-btn" onclick="return confirm('Tem certeza que deseja excluir este relatório?')">Excluir</button>
     </form>
@@ -711,6 +2145,12 @@ reports_template = """
         </div>
         <div style="margin-top: 20px">
             <a href="{{ url_for('home') }}" class="back-btn">Voltar para Upload</a>
+            {% if is_paged %}
+            <a href="{{ url_for('reports', per_page=per_page) }}" class="back-btn">Mais recentes</a>
+            {% endif %}
+            {% if next_cursor %}
+            <a href="{{ url_for('reports', before_date=next_cursor.date, before_id=next_cursor.id, per_page=per_page) }}" class="back-btn">Próxima página</a>
+            {% endif %}
         </div>
     </div>
 </body>
@@ -992,7 +2432,8 @@ removed_os_template = """
 
         <div class="summary-box">
             <h3>Resumo</h3>
-            <p>Total de OS removidas: <strong>{{ removed_os|length }}</strong></p>
+            <p>Total de OS removidas: <strong id="removedCount">{{ removed_os|length }}</strong></p>
+            <ul id="technicianTotals"></ul>
         </div>
 
         <div class="removed-os-list">
@@ -1013,8 +2454,10 @@ removed_os_template = """
                             <strong>Data da Remoção:</strong> {{ os.removed_date }}
                         </div>
                         <div class="restore-btn-container">
-                            <button class="restore-btn" 
-                                    onclick="restoreOS('{{ os.contract_id }}', '{{ os.technician }}', '{{ os.motivo }}', {{ report_id }})">
+                            <button class="restore-btn" onclick="restoreOS(this)"
+                                    data-contract-id="{{ os.contract_id }}"
+                                    data-technician="{{ os.technician }}"
+                                    data-motivo="{{ os.motivo }}">
                                 Retornar OS
                             </button>
                         </div>
@@ -1030,25 +2473,54 @@ removed_os_template = """
         <a href="{{ url_for('reports') }}" class="back-btn">Voltar para Lista</a>
     </div>
     <script>
-function restoreOS(contractId, technician, motivo, reportId) {
+const reportId = {{ report_id|tojson }};
+
+// Updated totals of the technicians whose OS came back, as returned by the server
+function showTechnicianTotals(technicians) {
+    const list = document.getElementById('technicianTotals');
+    technicians.forEach(tech => {
+        const key = tech['Técnico'].toLowerCase();
+        let item = Array.from(list.children).find(li => li.dataset.technician === key);
+        if (!item) {
+            item = document.createElement('li');
+            item.dataset.technician = key;
+            list.appendChild(item);
+        }
+        item.textContent = `${tech['Técnico']}: ${tech['Quantidade de OS']} OS, ` +
+                           `R$ ${tech['Valor Total'].toFixed(2)}`;
+    });
+}
+
+function restoreOS(button) {
     if (confirm('Tem certeza que deseja retornar esta OS ao relatório?')) {
-        const formData = new FormData();
-        formData.append('contract_id', contractId);
-        formData.append('technician', technician);
-        formData.append('motivo', motivo);
-        formData.append('report_id', reportId);
+        const item = {
+            contract_id: button.dataset.contractId,
+            technician: button.dataset.technician,
+            motivo: button.dataset.motivo
+        };
         
-        fetch('/restore_os', {
+        fetch('/restore_os/batch', {
             method: 'POST',
-            body: formData
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({report_id: reportId, items: [item]})
         })
         .then(response => response.json())
         .then(data => {
-            if (data.success) {
-                location.reload();
-            } else {
+            if (!data.success) {
                 alert('Erro ao retornar OS: ' + data.error);
+                return;
             }
+            if (!data.applied[0]) {
+                alert('Esta OS já não consta como removida deste relatório.');
+            }
+            button.closest('.removed-os-item').remove();
+            const count = document.getElementById('removedCount');
+            count.textContent = Number(count.textContent) - 1;
+            if (count.textContent === '0') {
+                document.querySelector('.removed-os-list').innerHTML =
+                    '<div class="empty-message"><p>Nenhuma OS foi removida deste relatório.</p></div>';
+            }
+            showTechnicianTotals(data.technicians);
         });
     }
 }
@@ -1057,288 +2529,1330 @@ function restoreOS(contractId, technician, motivo, reportId) {
 </html>
 """
 
-@app.route('/', methods=['GET'])
-def home():
-    return render_template_string(html_template)
+# Templates registrados por nome: o Jinja compila cada um uma única vez e reaproveita
+# o template compilado nas próximas requisições
+TEMPLATES = {
+    'index.html': html_template,
+    'reports.html': reports_template,
+    'chart.html': chart_template,
+    'removed_os.html': removed_os_template,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+
+def compile_templates():
+    """
+    Compila todos os templates na inicialização, antes da primeira requisição
+    """
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+# Muda quando os templates mudam, para que um deploy invalide os ETags das páginas
+TEMPLATES_DIGEST = hashlib.sha256(''.join(TEMPLATES.values()).encode('utf-8')).hexdigest()[:8]
+
+def get_report_state(c, report_id):
+    """
+    Retorna (filename, version, updated_date) do relatório, ou None se não existir
+    """
+    c.execute('SELECT filename, version, updated_date FROM reports WHERE id = ?', (report_id,))
+    return c.fetchone()
+
+def conditional_response(report_id, state, page, render):
+    """
+    Responde 304 se o cliente já tem esta versão da página (If-None-Match /
+    If-Modified-Since); senão chama render() e anexa ETag e Last-Modified
+    """
+    _, version, updated_date = state
+    etag = f'{page}-{report_id}-v{version}-{TEMPLATES_DIGEST}'
+    last_modified = datetime.strptime(updated_date, '%Y-%m-%d %H:%M:%S')
+    
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = bool(request.if_modified_since) and \
+            last_modified <= request.if_modified_since.replace(tzinfo=None)
+    
+    response = app.response_class(status=304) if not_modified else make_response(render())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True  # O navegador sempre revalida
+    return response
+
+@app.route('/', methods=['GET'])
+def home():
+    return render_template('index.html')
+
+def normalize_cell(value):
+    """
+    Converte valores numéricos inteiros lidos como float (ex.: 7054.0) para int,
+    como o pandas faz ao ler o Excel
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def build_os_batch(rows, columns):
+    """
+    Monta um DataFrame tipado a partir de um lote de linhas da planilha
+    """
+    return type_id_columns(pd.DataFrame(rows, columns=columns, dtype=object))
+
+def type_id_columns(batch):
+    """
+    Converte as colunas de ID para inteiro (com vazios) quando todos os valores são números
+    """
+    for column in OS_ID_COLUMNS:
+        if column in batch.columns:
+            try:
+                batch[column] = batch[column].astype('Int64')
+            except (TypeError, ValueError):
+                pass  # IDs com texto permanecem como object
+    return batch
+
+def find_os_header(worksheet, columns, optional_columns=()):
+    """
+    Localiza a linha de cabeçalho pelos nomes das colunas e devolve o número da
+    linha (base 1) e a posição de cada coluna pedida (None para opcionais ausentes)
+    """
+    for row_number, row in enumerate(worksheet.iter_rows(values_only=True), start=1):
+        header = [str(cell).strip() if cell is not None else None for cell in row]
+        if all(column in header for column in columns):
+            positions = [header.index(column) for column in columns]
+            positions += [header.index(column) if column in header else None for column in optional_columns]
+            return row_number, positions
+    raise ValueError("Cabeçalho da planilha de OS não encontrado")
+
+def iter_os_batches(file_path, columns=OS_PIPELINE_COLUMNS, batch_size=READ_BATCH_SIZE,
+                    optional_columns=OS_OPTIONAL_COLUMNS):
+    """
+    Lê a planilha "Ordens de Serviço" linha a linha em modo somente leitura,
+    localiza o cabeçalho pelos nomes das colunas (sem deslocamento fixo) e
+    produz lotes tipados contendo apenas as colunas pedidas; colunas opcionais
+    ausentes na planilha vêm vazias. As linhas são lidas inteiras: no modo
+    somente leitura o openpyxl converte todas as células antes de aplicar
+    min_col/max_col, então limitar o intervalo não economiza nada
+    """
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        if OS_SHEET_NAME not in workbook.sheetnames:
+            raise ValueError(f'Planilha "{OS_SHEET_NAME}" não encontrada no arquivo')
+        worksheet = workbook[OS_SHEET_NAME]
+        header_row, positions = find_os_header(worksheet, columns, optional_columns)
+        all_columns = list(columns) + list(optional_columns)
+
+        batch = []
+        for row in worksheet.iter_rows(min_row=header_row + 1, values_only=True):
+            values = tuple(normalize_cell(row[i]) if i is not None and i < len(row) else None
+                           for i in positions)
+            if all(value is None for value in values[:len(columns)]):
+                continue  # Ignorar linhas em branco
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield build_os_batch(batch, all_columns)
+                batch = []
+        if batch:
+            yield build_os_batch(batch, all_columns)
+    finally:
+        workbook.close()
+
+def compile_motivo_exclusions(exclusions):
+    """
+    Converte a lista (tipo, padrão) em valores exatos, prefixos e expressões
+    regulares; o resultado pode ser enviado aos processos de leitura. Cada
+    expressão é compilada à parte: juntá-las numa só quebraria flags no início
+    do padrão ("(?i)...") e renumeraria as referências a grupos
+    """
+    return {
+        'exact': frozenset(pattern for kind, pattern in exclusions if kind == 'exact'),
+        'prefixes': tuple(pattern for kind, pattern in exclusions if kind == 'prefix'),
+        'regex': tuple(re.compile(pattern) for kind, pattern in exclusions if kind == 'regex'),
+    }
+
+def is_excluded_motivo(motivo, exclusions):
+    """
+    Indica se um motivo está fora da comissão
+    """
+    return (motivo in exclusions['exact']
+            or motivo.startswith(exclusions['prefixes'])
+            or any(regex.search(motivo) is not None for regex in exclusions['regex']))
 
-def get_first_name(full_name):
+def excluded_motivo_mask(motivos, exclusions):
     """
-    Extrai o primeiro nome de um nome completo
+    Máscara das OS com motivo excluído. As exclusões são avaliadas uma vez por
+    motivo distinto (categoria) e a máscara sai dos códigos da coluna
     """
-    if not isinstance(full_name, str):
-        return ""
-    return full_name.split()[0].lower().strip() if full_name.split() else ""
+    categories = motivos.astype('category')
+    excluded = [is_excluded_motivo(str(motivo), exclusions) for motivo in categories.cat.categories]
+    # Motivo vazio tem código -1 e cai na última posição, que nunca é excluída
+    lookup = pd.Series(excluded + [False], dtype=bool).to_numpy()
+    return pd.Series(lookup[categories.cat.codes.to_numpy()], index=motivos.index)
 
-def get_all_name_parts(full_name):
+def drop_excluded_motivos(batch, exclusions):
     """
-    Retorna todas as partes do nome como uma lista
+    Remove do lote as OS cujo motivo não entra na comissão
     """
-    if not isinstance(full_name, str):
-        return []
-    return [part.lower().strip() for part in full_name.split()]
+    return batch[~excluded_motivo_mask(batch['Motivo'], exclusions)]
+
+def parse_os_file(file_path):
+    """
+    Lê uma planilha inteira e devolve (OS ou None, linhas lidas).
+    Executada nos processos do pool quando o envio tem vários arquivos
+    """
+    batches = list(iter_os_batches(file_path))
+    frame = pd.concat(batches, ignore_index=True) if batches else None
+    return frame, 0 if frame is None else len(frame)
+
+def fold_name(value):
+    """
+    Forma de comparação de um nome: sem acentos, minúsculas e com espaços simples
+    ("  Conceição " -> "conceicao")
+    """
+    decomposed = unicodedata.normalize('NFKD', str(value))
+    return ' '.join(''.join(ch for ch in decomposed if not unicodedata.combining(ch)).lower().split())
+
+def bounded_edit_distance(a, b, limit):
+    """
+    Distância de edição (Levenshtein) entre a e b; para assim que passa de limit
+    e retorna limit + 1
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+def fuzzy_limit(alias):
+    """
+    Quantas edições aceitar numa correspondência aproximada (nomes curtos só por igualdade)
+    """
+    if len(alias) < FUZZY_MIN_LENGTH:
+        return 0
+    return 1 if len(alias) < 8 else 2
 
-def normalize_technician_name(name):
+def normalized_responsible_names(df_cleaned):
     """
-    Normaliza o nome de um técnico para facilitar a comparação e evitar duplicidades.
+    Coluna de responsáveis normalizada (minúsculas, espaços simples), sem vazios
     """
-    if not isinstance(name, str):
-        return ""
-    return name.strip().lower()
+    responsible_names = df_cleaned['Responsável'].dropna().astype(str).str.lower().str.split().str.join(' ')
+    return responsible_names[responsible_names != '']
 
-def extract_first_names(technician_str):
+def canonical_responsible_names(df_cleaned, index=None):
     """
-    Extrai apenas o primeiro nome de cada técnico auxiliar
+    Responsáveis normalizados com as variações de grafia (acentos, maiúsculas,
+    espaços) unificadas: prevalece o nome já cadastrado ou, se não houver, a
+    grafia mais frequente no upload
     """
-    if not isinstance(technician_str, str):
+    responsible_names = normalized_responsible_names(df_cleaned)
+    counts = responsible_names.value_counts(sort=False)
+    canonical = {}
+    preferred = {}
+    for name, _ in sorted(counts.items(), key=lambda item: -item[1]):
+        key = fold_name(name)
+        registered = index.get(('name', key)) if index else None
+        if registered and len(registered) == 1:
+            canonical[name] = next(iter(registered))
+        else:
+            canonical[name] = preferred.setdefault(key, name)
+    return responsible_names.map(canonical)
+
+def build_alias_index(names):
+    """
+    Índice (tipo, apelido) -> nomes completos montado só com os nomes informados,
+    usado quando não há cadastro (ex.: testes)
+    """
+    index = {}
+    for name in names:
+        parts = fold_name(name).split()
+        index.setdefault(('name', ' '.join(parts)), set()).add(name)
+        index.setdefault(('first_name', parts[0]), set()).add(name)
+        for part in parts[1:]:
+            index.setdefault(('name_part', part), set()).add(name)
+    return index
+
+def learn_login_aliases(df_cleaned, responsible_names):
+    """
+    Associa logins (Usuário / Finalizado Por) ao responsável quando o login aparece
+    quase sempre com ele e começa com uma parte do nome dele (ex.: "marcosv").
+    Atendentes abrem OS para todos e auxiliares encerram OS do responsável, então
+    os logins deles não passam nas duas condições
+    """
+    pairs = [
+        pd.DataFrame({
+            'login': df_cleaned.loc[responsible_names.index, column].astype(object).values,
+            'tecnico': responsible_names.astype(object).values,
+        })
+        for column in OS_LOGIN_COLUMNS if column in df_cleaned.columns
+    ]
+    if not pairs:
         return []
-    
-    # Substituir múltiplos delimitadores por vírgulas
-    normalized = re.sub(r'[;/|]+', ',', technician_str)
-    
-    # Dividir por vírgula
+    pairs = pd.concat(pairs, ignore_index=True).dropna()
+    logins = pairs['login'].astype(str)
+    pairs['login'] = logins.map({login: fold_name(login) for login in logins.unique()})
+    pairs = pairs[pairs['login'] != '']
+    counts = pairs.groupby(['login', 'tecnico']).size()
+    total = counts.groupby(level='login').transform('sum')
+    dominant = counts[(total >= LOGIN_MIN_ROWS) & (counts / total >= LOGIN_MATCH_SHARE)]
+    return [
+        (login, tech)
+        for login, tech in dominant.index
+        if any(login.startswith(part) for part in fold_name(tech).split() if len(part) >= 3)
+    ]
+
+def build_blocking_index(index):
+    """
+    Agrupa os primeiros nomes e logins do índice pelas letras iniciais, para que um
+    nome desconhecido seja comparado só com os do mesmo bloco
+    """
+    blocks = {}
+    for kind, alias in index:
+        if kind in FUZZY_KINDS:
+            blocks.setdefault(alias[:FUZZY_BLOCK_PREFIX], []).append((kind, alias))
+    return blocks
+
+def match_alias(alias, index, blocks):
+    """
+    Candidatos para um apelido (sem acentos) e a distância da correspondência: por
+    igualdade, na ordem login, primeiro nome e demais partes do nome; senão, os
+    primeiros nomes e logins mais próximos do mesmo bloco dentro do limite de edições
+    """
+    for kind in ALIAS_KINDS:
+        candidates = index.get((kind, alias))
+        if candidates:
+            return candidates, 0
+    limit = fuzzy_limit(alias)
+    nearest = {}
+    if limit:
+        for kind, known in blocks.get(alias[:FUZZY_BLOCK_PREFIX], ()):
+            distance = bounded_edit_distance(alias, known, limit)
+            if distance <= limit:
+                nearest.setdefault(distance, set()).update(index[(kind, known)])
+    if not nearest:
+        return None, None
+    distance = min(nearest)
+    return nearest[distance], distance
+
+def resolve_aliases(aliases, active_names, index):
+    """
+    Resolve cada apelido para um nome completo, preferindo técnicos presentes no
+    upload. Devolve os resolvidos e a lista para revisão: correspondências
+    aproximadas e apelidos com mais de um candidato (que ficam sem resolução)
+    """
+    blocks = build_blocking_index(index)
+    resolved = {}
+    review = []
+    for alias in aliases:
+        candidates, distance = match_alias(alias, index, blocks)
+        if not candidates:
+            continue
+        chosen = (candidates & active_names) or candidates
+        if len(chosen) == 1:
+            resolved[alias] = next(iter(chosen))
+            if distance:
+                review.append({'auxiliar': alias, 'tecnico': resolved[alias], 'distancia': distance})
+        else:
+            review.append({'auxiliar': alias, 'candidatos': sorted(chosen), 'distancia': distance})
+    return resolved, review
+
+# Separadores aceitos entre os técnicos auxiliares ("weslley / ramiro", "jadiel; lucas")
+AUX_SEPARATORS = re.compile(r'[;/|,]+')
+
+# Cache (LRU) valor bruto -> primeiros nomes, compartilhado pelos uploads
+aux_parse_cache = OrderedDict()
+aux_parse_stats = {'rows': 0, 'distinct': 0, 'hits': 0, 'misses': 0}
+aux_parse_lock = threading.Lock()
+
+def parse_auxiliary_names(raw):
+    """
+    Primeiros nomes (sem acentos, sem repetição, na ordem) citados num valor da
+    coluna de auxiliares
+    """
     names = []
-    for tech in normalized.split(','):
-        tech = tech.strip()
-        if tech:
-            # Para cada nome completo, pegar apenas o primeiro nome
-            first_name = tech.split()[0] if tech.split() else ""
-            if first_name:
-                names.append(normalize_technician_name(first_name))
-    
-    # Remover duplicatas
-    return list(dict.fromkeys(names))
+    for part in AUX_SEPARATORS.split(str(raw).lower()):
+        words = part.split()
+        if words:
+            name = fold_name(words[0])
+            if name not in names:
+                names.append(name)
+    return tuple(names)
+
+def parse_auxiliary_names_cached(values):
+    """
+    Interpreta os valores distintos da coluna, cada um uma única vez, reaproveitando
+    o que já foi interpretado em uploads anteriores; devolve valor -> primeiros nomes
+    """
+    parsed = {}
+    with aux_parse_lock:
+        for value in values:
+            names = aux_parse_cache.get(value)
+            if names is None:
+                aux_parse_stats['misses'] += 1
+                names = parse_auxiliary_names(value)
+                aux_parse_cache[value] = names
+                if len(aux_parse_cache) > AUX_PARSE_CACHE_SIZE:
+                    aux_parse_cache.popitem(last=False)
+            else:
+                aux_parse_stats['hits'] += 1
+                aux_parse_cache.move_to_end(value)
+            parsed[value] = names
+    return parsed
+
+def explode_auxiliary_names(auxiliary_values):
+    """
+    Devolve um DataFrame (linha, primeiro nome sem acentos) com um registro por
+    técnico auxiliar, sem repetições dentro da mesma linha. Cada texto distinto da
+    coluna é interpretado uma vez (os mesmos valores se repetem centenas de vezes)
+    """
+    values = auxiliary_values.dropna()
+    distinct = values.unique()
+    parsed = parse_auxiliary_names_cached(distinct)
+    with aux_parse_lock:
+        aux_parse_stats['rows'] += len(values)
+        aux_parse_stats['distinct'] += len(distinct)
+    names = values.map(parsed).explode().dropna()
+    return pd.DataFrame({'linha': names.index.values, 'auxiliar': names.astype(object).values})
+
+def os_types(df_cleaned):
+    """
+    Tipo de cada OS (Externa/Interna) sem espaços nas pontas; vazio quando ausente
+    """
+    if 'Tipo' not in df_cleaned.columns:
+        return pd.Series(pd.NA, index=df_cleaned.index, dtype='string')
+    return df_cleaned['Tipo'].astype('string').str.strip()
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return "Nenhum arquivo enviado", 400
-    file = request.files['file']
-    if file.filename == '':
-        return "Nenhum arquivo selecionado", 400
-    
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(file_path)
-    
-    # Processar o arquivo
-    xls = pd.ExcelFile(file_path)
-    df = pd.read_excel(xls, sheet_name="Ordens de Serviço")
-    df_cleaned = df.iloc[6:].reset_index(drop=True)
-    df_cleaned.columns = df_cleaned.iloc[0]  # Definir a primeira linha como cabeçalho
-    df_cleaned = df_cleaned[1:].reset_index(drop=True)
-    
-    # Remover os tipos de OS "Financeiro" e "Entrega de Carnê"
-    df_cleaned = df_cleaned[~df_cleaned['Motivo'].isin(['Financeiro', 'Entrega de Carnê'])]
-    
-    # Dicionário para mapear primeiros nomes aos nomes completos
-    name_mapping = {}
-    tech_full_names = set()
-
-    # Primeiro passo: coletar todos os nomes completos dos responsáveis
-    for index, row in df_cleaned.iterrows():
-        if pd.notna(row['Responsável']):
-            full_name = normalize_technician_name(str(row['Responsável']))
-            first_name = get_first_name(full_name)
-            name_parts = get_all_name_parts(full_name)
-            
-            for part in name_parts:
-                name_mapping[part] = full_name
-            tech_full_names.add(full_name)
-
-    # Usar um dicionário para armazenar os dados de cada técnico
-    technician_data = {}
-    processed_techs = set()
-
-    # Processar cada linha do DataFrame
-    for index, row in df_cleaned.iterrows():
-        motivo = row['Motivo'] if pd.notna(row['Motivo']) else "Não especificado"
-        processed_techs.clear()
-
-        # Processar responsável
-        if pd.notna(row['Responsável']):
-            tech = normalize_technician_name(str(row['Responsável']))
-            if tech and tech not in processed_techs:
-                if tech not in technician_data:
-                    technician_data[tech] = {
-                        "Técnico": tech,
-                        "Quantidade de OS": 0,
-                        "Valor Total": 0,
-                        "Motivos": Counter(),
-                        "Contratos": {}  # Add this line
-                    }
-                technician_data[tech]["Quantidade de OS"] += 1
-                technician_data[tech]["Valor Total"] += 3
-                technician_data[tech]["Motivos"][motivo] += 1
-                processed_techs.add(tech)
-
-                # When processing each row, add the contract ID:
-                if pd.notna(row['ID Contrato']):
-                    if motivo not in technician_data[tech]["Contratos"]:
-                        technician_data[tech]["Contratos"][motivo] = []
-                    technician_data[tech]["Contratos"][motivo].append(str(row['ID Contrato']))
-
-        # Processar técnicos auxiliares
-        if pd.notna(row['Técnico(s) auxiliar(s)']):
-            aux_techs = extract_first_names(str(row['Técnico(s) auxiliar(s)']))
-            for aux_tech in aux_techs:
-                # Verificar se o primeiro nome corresponde a algum técnico conhecido
-                matched_full_name = name_mapping.get(aux_tech)
-                
-                if matched_full_name and matched_full_name not in processed_techs:
-                    # Usar o nome completo correspondente
-                    tech = matched_full_name
-                elif aux_tech not in processed_techs:
-                    # Usar apenas o primeiro nome se não houver correspondência
-                    tech = aux_tech
-
-                if tech not in processed_techs:
-                    if tech not in technician_data:
-                        technician_data[tech] = {
-                            "Técnico": tech,
-                            "Quantidade de OS": 0,
-                            "Valor Total": 0,
-                            "Motivos": Counter(),
-                            "Contratos": {}  # Add this line
-                        }
-                    technician_data[tech]["Quantidade de OS"] += 1
-                    technician_data[tech]["Valor Total"] += 3
-                    technician_data[tech]["Motivos"][motivo] += 1
-                    processed_techs.add(tech)
+def os_closing_times(df_cleaned):
+    """
+    Data e hora de encerramento de cada OS; NaT quando ausente ou em formato não reconhecido
+    """
+    if 'Encerrada' not in df_cleaned.columns:
+        return pd.Series(pd.NaT, index=df_cleaned.index, dtype='datetime64[ns]')
+    return pd.to_datetime(df_cleaned['Encerrada'], errors='coerce', format='ISO8601')
 
-                    # When processing each row, add the contract ID:
-                    if pd.notna(row['ID Contrato']):
-                        if motivo not in technician_data[tech]["Contratos"]:
-                            technician_data[tech]["Contratos"][motivo] = []
-                        technician_data[tech]["Contratos"][motivo].append(str(row['ID Contrato']))
+def os_closing_dates(df_cleaned):
+    """
+    Dia de encerramento de cada OS; NaT quando ausente ou em formato não reconhecido
+    """
+    return os_closing_times(df_cleaned).dt.normalize()
+
+def build_assignments(df_cleaned, alias_index=None):
+    """
+    Explode cada OS em uma linha por técnico creditado (responsável + auxiliares,
+    com os primeiros nomes resolvidos para o nome completo pelo índice de apelidos;
+    sem índice, só os responsáveis do próprio upload são considerados). Cada técnico
+    recebe no máximo um crédito por OS, mesmo citado de novo como auxiliar. Retorna
+    (atribuições, nomes de auxiliares para revisão)
+    """
+    df_cleaned = df_cleaned.reset_index(drop=True)
+    motivos = df_cleaned['Motivo'].fillna("Não especificado")
+    contracts = df_cleaned['ID Contrato'].map(str, na_action='ignore')
+    types = os_types(df_cleaned)
+    dates = os_closing_dates(df_cleaned)
+
+    # Responsáveis normalizados (posição -1 para vir antes dos auxiliares na mesma linha)
+    responsible_names = canonical_responsible_names(df_cleaned, alias_index)
+    active_names = set(responsible_names)
+    if alias_index is None:
+        alias_index = build_alias_index(active_names)
+    resp = pd.DataFrame({
+        'linha': responsible_names.index.values,
+        'posicao': -1,
+        'tecnico': responsible_names.values,
+    })
+
+    # Auxiliares: primeiro nome resolvido para o nome completo quando houver correspondência
+    aux = explode_auxiliary_names(df_cleaned['Técnico(s) auxiliar(s)'])
+    aux['posicao'] = aux.groupby('linha').cumcount()
+    resolved, review = resolve_aliases(aux['auxiliar'].unique(), active_names, alias_index)
+    aux['tecnico'] = aux['auxiliar'].map(resolved).fillna(aux['auxiliar'])
+    occurrences = aux['auxiliar'].value_counts()
+    for item in review:
+        item['ocorrencias'] = int(occurrences[item['auxiliar']])
+
+    # Cada técnico é creditado uma vez por OS: um auxiliar que leva ao responsável
+    # (ou a outro auxiliar já citado) não vira um técnico à parte com o primeiro nome,
+    # como acontecia no laço original (ver AGGREGATION_VERSION 3)
+    assignments = (pd.concat([resp, aux], ignore_index=True)
+                   .sort_values(['linha', 'posicao'], kind='stable')
+                   .drop_duplicates(['linha', 'tecnico'])
+                   .reset_index(drop=True)[['linha', 'posicao', 'tecnico']])
+
+    row_positions = assignments['linha'].values
+    assignments['Motivo'] = motivos.values[row_positions]
+    assignments['Contrato'] = contracts.values[row_positions]
+    assignments['Tipo'] = types.values[row_positions]
+    assignments['Data'] = dates.values[row_positions]
+    assignments['papel'] = 'auxiliar'
+    assignments.loc[assignments['posicao'] < 0, 'papel'] = 'responsavel'
+    return assignments, review
+
+def commission_values(assignments, rules):
+    """
+    Comissão de cada atribuição: vale a primeira regra (da mais específica para a
+    mais genérica) que casar com motivo, tipo, papel e data de encerramento da OS;
+    sem regra aplicável, zero. As regras são avaliadas uma vez por combinação
+    distinta (motivo, tipo, papel e, se alguma regra tiver período, dia) e o valor
+    sai de um vetor indexado pelo código da combinação
+    """
+    keys = pd.DataFrame({
+        'motivo': assignments['Motivo'].astype(object),
+        'tipo': assignments['Tipo'].astype(object),
+        'role': assignments['papel'].astype(object),
+        'date': assignments['Data'] if rules['has_periods'] else pd.NaT,
+    })
+    codes = keys.groupby(list(keys.columns), sort=False, dropna=False).ngroup().to_numpy()
+    lookup = [0.0] * (codes.max() + 1 if len(codes) else 0)
+    first = ~pd.Series(codes).duplicated().to_numpy()
+    for code, (motivo, tipo, role, date) in zip(codes[first], keys[first].itertuples(index=False)):
+        lookup[code] = commission_rate(rules, motivo, None if pd.isna(tipo) else tipo, role, date)
+    return pd.Series(pd.Series(lookup, dtype=float).to_numpy()[codes], index=assignments.index)
+
+def summarize_assignments(assignments):
+    """
+    Agrupa as atribuições por técnico e motivo e monta a lista summary_data
+    usada pelos templates
+    """
+    total_by_tech = assignments.groupby('tecnico', sort=False).size()
+    value_by_tech = assignments.groupby('tecnico', sort=False)['Valor'].sum()
+    count_by_motivo = assignments.groupby(['tecnico', 'Motivo'], sort=False).size()
+    with_contract = (assignments.dropna(subset=['Contrato'])
+                     .groupby(['tecnico', 'Motivo'], sort=False))
+    contracts_by_motivo = with_contract['Contrato'].agg(list)
+    values_by_motivo = with_contract['Valor'].agg(list)
 
-    # Verificar se temos dados para processar
-    if not technician_data:
-        return "Nenhum técnico encontrado nos dados", 400
-    
     # Converter para o formato de resumo
+    motivos_by_tech = {}
+    for (tech, motivo), quantidade in count_by_motivo.items():
+        motivos_by_tech.setdefault(tech, []).append((motivo, int(quantidade)))
+
     summary_data = []
-    for tech_info in technician_data.values():
-        total_os = tech_info["Quantidade de OS"]
+    for tech, total_os in total_by_tech.items():
+        total_os = int(total_os)
         motivos_list = [
             {
                 "Motivo": motivo,
                 "Quantidade": quantidade,
                 "Porcentagem": round((quantidade / total_os) * 100, 1),
-                "Contratos": tech_info["Contratos"].get(motivo, [])  # Add this line
+                "Contratos": contracts_by_motivo.get((tech, motivo), []),
+                "Valores": values_by_motivo.get((tech, motivo), [])
             }
-            for motivo, quantidade in tech_info["Motivos"].items()
+            for motivo, quantidade in motivos_by_tech[tech]
         ]
         summary_data.append({
-            "Técnico": tech_info["Técnico"].title(),
+            "Técnico": tech.title(),
             "Quantidade de OS": total_os,
-            "Valor Total": tech_info["Valor Total"],
+            "Valor Total": round(float(value_by_tech[tech]), 2),
             "Motivos": sorted(motivos_list, key=lambda x: x["Quantidade"], reverse=True)
         })
-    
+
     summary_data.sort(key=lambda x: x["Quantidade de OS"], reverse=True)
+    return summary_data
+
+def summary_for_page(summary_data):
+    """
+    Cópia leve do summary_data para a página: troca a lista de contratos de cada
+    motivo pela quantidade ("Total Contratos"); as listas são buscadas sob demanda
+    """
+    return [
+        dict(tech, Motivos=[
+            {
+                "Motivo": motivo["Motivo"],
+                "Quantidade": motivo["Quantidade"],
+                "Porcentagem": motivo["Porcentagem"],
+                "Total Contratos": len(motivo["Contratos"])
+            }
+            for motivo in tech["Motivos"]
+        ])
+        for tech in summary_data
+    ]
+
+def contracts_page_args():
+    """
+    Lê técnico, motivo e paginação (offset/limit) da query string
+    """
+    technician = request.args.get('technician', '')
+    motivo = request.args.get('motivo', '')
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', CONTRACTS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, CONTRACTS_MAX_PAGE_SIZE))
+    return technician, motivo, offset, limit
+
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+upload_slots = threading.BoundedSemaphore(UPLOAD_WORKERS + UPLOAD_QUEUE_LIMIT)
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
+def get_parse_pool():
+    """
+    Pool de processos para ler planilhas, criado no primeiro envio com vários arquivos.
+    Os processos são iniciados com spawn: um fork do servidor (com várias threads)
+    poderia copiar um lock já adquirido e travar o processo filho
+    """
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None:
+            parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return parse_pool
+
+def batch_identity(uploads):
+    """
+    Nome e hash de um envio: o próprio arquivo quando é um só; para vários, um
+    resumo dos nomes e o hash dos conteúdos (sem depender da ordem de envio)
+    """
+    if len(uploads) == 1:
+        return uploads[0][0], uploads[0][1]
+    names = sorted(filename for filename, _, _ in uploads)
+    hashes = '\n'.join(sorted(file_hash for _, file_hash, _ in uploads))
+    label = f'{len(uploads)} arquivos ({names[0]} a {names[-1]})'
+    return label, hashlib.sha256(hashes.encode('utf-8')).hexdigest()
+
+def create_upload_job(filename, file_hash, files=1):
+    """
+    Registra um upload na fila e retorna o id do job
+    """
+    job_id = secrets.token_urlsafe(16)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    conn.execute('''
+        INSERT INTO upload_jobs (id, filename, file_hash, status, files, created_date, updated_date)
+        VALUES (?, ?, ?, 'queued', ?, ?, ?)
+    ''', (job_id, filename, file_hash, files, now, now))
+    conn.commit()
+    return job_id
+
+def update_upload_job(job_id, **fields):
+    """
+    Atualiza o andamento de um job (status, stage, rows, error, staging_token)
+    """
+    fields['updated_date'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    conn = get_db()
+    conn.execute(f'UPDATE upload_jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+    conn.commit()
+
+def get_upload_job(job_id):
+    """
+    Retorna o job como dicionário, ou None
+    """
+    c = get_db().cursor()
+    c.execute('''
+        SELECT id, filename, status, stage, rows, files, files_done, error, staging_token, name_review
+        FROM upload_jobs WHERE id = ?
+    ''', (job_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['name_review'] = json.loads(job['name_review'] or '[]')
+    return job
+
+def read_os_files(job_id, uploads):
+    """
+    Lê as planilhas enviadas e devolve as OS (ou None), ainda sem as exclusões de motivo.
+    Um arquivo só é lido aqui mesmo, lote a lote; vários são lidos em paralelo no
+    pool de processos e as OS repetidas entre exportações (mesmo ID) contam uma vez,
+    pela cópia mais recente (ver merge_os_frames)
+    """
+    if len(uploads) == 1:
+        batches = []
+        rows_read = 0
+        for batch in iter_os_batches(uploads[0][2]):
+            rows_read += len(batch)
+            batches.append(batch)
+            update_upload_job(job_id, rows=rows_read)
+        return pd.concat(batches, ignore_index=True) if batches else None
+    
+    pool = get_parse_pool()
+    futures = [pool.submit(parse_os_file, file_path) for _, _, file_path in uploads]
+    filenames = {future: filename for future, (filename, _, _) in zip(futures, uploads)}
+    rows_read = 0
+    for files_done, future in enumerate(as_completed(futures), start=1):
+        try:
+            rows_read += future.result()[1]
+        except ValueError as e:
+            raise ValueError(f'{filenames[future]}: {e}')
+        update_upload_job(job_id, rows=rows_read, files_done=files_done)
+    
+    # Juntar na ordem do hash de cada arquivo, a mesma usada na chave de cache
+    # (batch_identity), para que a ordem de envio não mude o resultado
+    ordered = sorted(zip(uploads, futures), key=lambda item: item[0][1])
+    frames = [future.result()[0] for _, future in ordered]
+    return merge_os_frames([frame for frame in frames if frame is not None])
+
+def merge_os_frames(frames):
+    """
+    Junta as OS de várias exportações (já em ordem de hash do arquivo). Uma OS
+    presente em mais de uma fica com a cópia de encerramento mais recente; no
+    empate, a do último arquivo. A ordem das linhas mantida é a da junção
+    """
+    if not frames:
+        return None
+    df = pd.concat(frames, ignore_index=True)
+    closing_times = os_closing_times(df)
+    by_closing_time = closing_times.sort_values(kind='stable', na_position='first').index
+    latest = ~df.loc[by_closing_time].duplicated(subset='ID', keep='last')
+    keep = df['ID'].isna() | latest.reindex(df.index)
+    return df[keep].reset_index(drop=True)
+
+def process_upload(job_id, file_hash, uploads):
+    """
+    Lê e agrega as planilhas informando o andamento no job; retorna
+    (summary_data, nomes de auxiliares para revisão, cache_hit). Problemas no
+    conteúdo dos arquivos levantam ValueError com a mensagem para o usuário
+    """
+    # As regras de comissão vigentes no início valem para todo o processamento
+    conn = get_db()
+    rule_set_version = get_active_rule_set_version(conn)
+    update_upload_job(job_id, status='running', stage='cache_lookup', rule_set_version=rule_set_version)
+    # O mesmo arquivo pode ter sido processado por outro job enquanto este esperava na fila
+    with timed_stage('cache_lookup'):
+        cached = find_cached_upload(conn, file_hash, rule_set_version)
+    if cached is not None:
+        update_upload_job(job_id, row_set_id=cached[2])
+        return cached[0], cached[1], True
+    
+    update_upload_job(job_id, stage='parse')
+    with timed_stage('parse') as span:
+        df_os = read_os_files(job_id, uploads)
+        span['rows'] = 0 if df_os is None else len(df_os)
+    if df_os is None:
+        raise ValueError("Nenhum técnico encontrado nos dados")
+    
+    # Guardar todas as OS lidas, para que um recálculo possa trazer de volta as de
+    # um motivo que deixe de ser excluído
+    update_upload_job(job_id, stage='store_rows')
+    with timed_stage('store_rows') as span:
+        row_set_id = store_os_rows(conn, file_hash, df_os)
+        span['rows'] = len(df_os)
+    update_upload_job(job_id, row_set_id=row_set_id)
+    
+    # Remover os motivos excluídos da comissão
+    df_cleaned = drop_excluded_motivos(df_os, load_motivo_exclusions(conn))
+    summary_data, name_review = summarize_os(job_id, df_cleaned, rule_set_version)
+    store_cached_summary(file_hash, summary_data, name_review, rule_set_version)
+    return summary_data, name_review, False
+
+def recompute_rows(job_id, row_set_id):
+    """
+    Recalcula um relatório a partir das OS guardadas, com o cadastro de técnicos,
+    as exclusões e as regras de comissão atuais; retorna como process_upload
+    """
+    conn = get_db()
+    rule_set_version = get_active_rule_set_version(conn)
+    update_upload_job(job_id, status='running', stage='load_rows',
+                      rule_set_version=rule_set_version, row_set_id=row_set_id)
+    with timed_stage('load_rows') as span:
+        df_cleaned = drop_excluded_motivos(load_os_rows(conn, row_set_id), load_motivo_exclusions(conn))
+        span['rows'] = len(df_cleaned)
+    update_upload_job(job_id, rows=len(df_cleaned))
+    summary_data, name_review = summarize_os(job_id, df_cleaned, rule_set_version)
+    return summary_data, name_review, False
+
+def summarize_os(job_id, df_cleaned, rule_set_version):
+    """
+    Identifica os técnicos, aplica as regras de comissão e totaliza; retorna
+    (summary_data, nomes de auxiliares para revisão)
+    """
+    update_upload_job(job_id, stage='name_mapping')
+    with timed_stage('name_mapping') as span:
+        alias_index = register_technicians(get_db(), df_cleaned)
+        assignments, name_review = build_assignments(df_cleaned, alias_index)
+        span['rows'] = len(assignments)
+    update_upload_job(job_id, stage='commission')
+    with timed_stage('commission') as span:
+        rules = load_commission_rules(get_db(), rule_set_version)
+        assignments['Valor'] = commission_values(assignments, rules)
+        span['rows'] = len(assignments)
+    update_upload_job(job_id, stage='aggregate')
+    with timed_stage('aggregate') as span:
+        summary_data = summarize_assignments(assignments)
+        span['rows'] = len(summary_data)
+
+    # Verificar se temos dados para processar
+    if not summary_data:
+        raise ValueError("Nenhum técnico encontrado nos dados")
+    return summary_data, name_review
+
+def run_upload_job(job_id, filename, file_hash, process):
+    """
+    Executa um job numa thread do pool, com contexto de aplicação próprio
+    (conexão com o banco e g.stage_timings do job), e libera a vaga na fila ao
+    terminar. process() faz o trabalho (process_upload ou recompute_rows)
+    """
+    try:
+        with app.app_context():
+            start = time.perf_counter()
+            try:
+                summary_data, name_review, cache_hit = process()
+            except ValueError as e:
+                update_upload_job(job_id, status='error', error=str(e))
+                return
+            except Exception:
+                app.logger.exception('Falha ao processar o upload %s', job_id)
+                update_upload_job(job_id, status='error', error='Erro inesperado ao processar o arquivo')
+                return
+            staging_token = stage_summary(filename, summary_data)
+            update_upload_job(job_id, status='done', stage=None, staging_token=staging_token,
+                              name_review=json.dumps(name_review))
+            log_upload_timings(filename, file_hash, cache_hit, time.perf_counter() - start)
+    finally:
+        upload_slots.release()
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    if 'file' not in request.files:
+        return "Nenhum arquivo enviado", 400
+    files = [file for file in request.files.getlist('file') if file.filename != '']
+    if not files:
+        return "Nenhum arquivo selecionado", 400
+    
+    # Cada item: (nome original, hash do conteúdo, caminho salvo)
+    uploads = []
+    with timed_stage('save_upload') as span:
+        for file in files:
+            uploads.append((file.filename, *save_upload(file)))
+        span['rows'] = len(uploads)
+    filename, file_hash = batch_identity(uploads)
+    
+    # Arquivo já processado com as regras vigentes: o resultado sai na hora, sem
+    # passar pela fila nem pelo acompanhamento do job
+    start = time.perf_counter()
+    conn = get_db()
+    rule_set_version = get_active_rule_set_version(conn)
+    with timed_stage('cache_lookup'):
+        cached = find_cached_upload(conn, file_hash, rule_set_version)
+    if cached is not None:
+        summary_data, name_review, row_set_id = cached
+        job_id = create_upload_job(filename, file_hash, len(uploads))
+        update_upload_job(job_id, status='done', rule_set_version=rule_set_version, row_set_id=row_set_id,
+                          staging_token=stage_summary(filename, summary_data),
+                          name_review=json.dumps(name_review))
+        log_upload_timings(filename, file_hash, True, time.perf_counter() - start)
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({
+                'job_id': job_id,
+                'status': 'done',
+                'status_url': url_for('upload_job_status', job_id=job_id),
+                'result_url': url_for('upload_job', job_id=job_id)
+            })
+        return redirect(url_for('upload_job', job_id=job_id), code=303)
+    
+    # Fila cheia: recusar em vez de acumular trabalho que o servidor não dá conta
+    if not upload_slots.acquire(blocking=False):
+        return "Muitos arquivos em processamento. Tente novamente em alguns instantes.", 503
+    try:
+        job_id = create_upload_job(filename, file_hash, len(uploads))
+        upload_executor.submit(run_upload_job, job_id, filename, file_hash,
+                               partial(process_upload, job_id, file_hash, uploads))
+    except Exception:
+        upload_slots.release()
+        raise
+    
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'job_id': job_id,
+            'status_url': url_for('upload_job_status', job_id=job_id)
+        }), 202
+    return redirect(url_for('upload_job', job_id=job_id), code=303)
+
+@app.route('/report/<int:report_id>/recompute', methods=['POST'])
+def recompute_report(report_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT r.filename, s.id, s.file_hash FROM reports r
+        LEFT JOIN os_row_sets s ON s.id = r.row_set_id
+        WHERE r.id = ?
+    ''', (report_id,))
+    row = c.fetchone()
+    if row is None:
+        return "Relatório não encontrado", 404
+    filename, row_set_id, file_hash = row
+    if row_set_id is None:
+        return "Este relatório foi salvo sem as OS de origem. Envie a planilha novamente.", 400
+    
+    if not upload_slots.acquire(blocking=False):
+        return "Muitos arquivos em processamento. Tente novamente em alguns instantes.", 503
+    try:
+        job_id = create_upload_job(filename, file_hash)
+        upload_executor.submit(run_upload_job, job_id, filename, file_hash,
+                               partial(recompute_rows, job_id, row_set_id))
+    except Exception:
+        upload_slots.release()
+        raise
+    
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'job_id': job_id,
+            'status_url': url_for('upload_job_status', job_id=job_id)
+        }), 202
+    return redirect(url_for('upload_job', job_id=job_id), code=303)
+
+@app.route('/upload/<job_id>')
+def upload_job(job_id):
+    job = get_upload_job(job_id)
+    if job is None:
+        return "Processamento não encontrado", 404
+    if job['status'] == 'error':
+        return job['error'], 400
+    if job['status'] != 'done':
+        # A página acompanha o andamento e recarrega quando o resultado fica pronto
+        return render_template('index.html', job=job)
+    
+    staged = get_staged_summary(job['staging_token'])
+    if staged is None:
+        return "Resultado expirado ou já salvo. Envie o arquivo novamente.", 400
+    filename, summary_data = staged
+    with timed_stage('render') as span:
+        page = render_template('index.html', 
+                                summary_data=summary_for_page(summary_data), 
+                                filename=filename,
+                                staging_token=job['staging_token'],
+                                contracts_url=url_for('get_staged_contracts', token=job['staging_token']),
+                                name_review=job['name_review'])
+        span['rows'] = len(summary_data)
+    return page
+
+@app.route('/upload/<job_id>/status')
+def upload_job_status(job_id):
+    job = get_upload_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Processamento não encontrado'}), 404
+    return jsonify({
+        'status': job['status'],
+        'stage': job['stage'],
+        'rows': job['rows'],
+        'files': job['files'],
+        'files_done': job['files_done'],
+        'error': job['error'],
+        'name_review': job['name_review'],
+        'result_url': url_for('upload_job', job_id=job_id) if job['status'] == 'done' else None
+    })
+
+@app.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/technicians')
+def list_technicians():
+    conn = get_db()
+    sync_technician_index(conn)
+    c = conn.cursor()
+    c.execute('''
+        SELECT t.name, t.first_seen, t.last_seen, a.kind, a.alias
+        FROM technicians t
+        LEFT JOIN technician_aliases a ON a.technician_id = t.id
+        ORDER BY t.name, a.kind, a.alias
+    ''')
+    technicians = {}
+    for row in c.fetchall():
+        tech = technicians.setdefault(row['name'], {
+            'name': row['name'],
+            'first_seen': row['first_seen'],
+            'last_seen': row['last_seen'],
+            'aliases': {}
+        })
+        if row['alias'] is not None:
+            tech['aliases'].setdefault(row['kind'], []).append(row['alias'])
+    return jsonify({
+        'technicians': list(technicians.values()),
+        'collisions': get_technician_collisions()
+    })
+
+@app.route('/motivo_exclusions', methods=['GET'])
+def list_motivo_exclusions():
+    c = get_db().cursor()
+    c.execute('SELECT id, kind, pattern, created_date FROM motivo_exclusions ORDER BY kind, pattern')
+    return jsonify({'exclusions': [dict(row) for row in c.fetchall()]})
+
+@app.route('/motivo_exclusions', methods=['POST'])
+def add_motivo_exclusion():
+    try:
+        kind, pattern = parse_motivo_exclusion(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            INSERT INTO motivo_exclusions (kind, pattern, created_date) VALUES (?, ?, ?)
+        ''', (kind, pattern, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'error': 'Exclusão já cadastrada'}), 400
+    conn.commit()
+    return jsonify({'success': True, 'id': c.lastrowid})
+
+@app.route('/motivo_exclusions/<int:exclusion_id>', methods=['DELETE'])
+def delete_motivo_exclusion(exclusion_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('DELETE FROM motivo_exclusions WHERE id = ?', (exclusion_id,))
+    if c.rowcount == 0:
+        return jsonify({'success': False, 'error': 'Exclusão não encontrada'}), 404
+    conn.commit()
+    return jsonify({'success': True})
+
+@app.route('/commission_rules', methods=['GET'])
+def list_commission_rules():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT version, created_date, description FROM commission_rule_sets ORDER BY version')
+    rule_sets = [dict(row, rules=[]) for row in c.fetchall()]
+    by_version = {rule_set['version']: rule_set for rule_set in rule_sets}
+    c.execute('''
+        SELECT rule_set_version, motivo, tipo, role, valid_from, valid_to, rate
+        FROM commission_rules ORDER BY rule_set_version, id
+    ''')
+    for row in c.fetchall():
+        rule = dict(row)
+        by_version[rule.pop('rule_set_version')]['rules'].append(rule)
+    return jsonify({
+        'active_version': get_active_rule_set_version(conn),
+        'rule_sets': rule_sets
+    })
+
+@app.route('/commission_rules', methods=['POST'])
+def create_commission_rules():
+    try:
+        description, rules = parse_commission_rules(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    version = create_commission_rule_set(get_db(), description, rules)
+    return jsonify({'success': True, 'version': version})
+
+@app.route('/staged/<token>/contracts')
+def get_staged_contracts(token):
+    technician, motivo, offset, limit = contracts_page_args()
+    staged = get_staged_summary(token)
+    if staged is None:
+        return jsonify({'error': 'Resultado expirado'}), 404
+    
+    contracts = []
+    for tech in staged[1]:
+        if tech['Técnico'].lower() == technician.lower():
+            for m in tech['Motivos']:
+                if m['Motivo'] == motivo:
+                    contracts = m['Contratos']
     
-    # Remove the database saving code from here
-    return render_template_string(html_template, 
-                                summary_data=summary_data, 
-                                filename=file.filename,
-                                report_data=json.dumps(summary_data))
+    return jsonify({
+        'contracts': contracts[offset:offset + limit],
+        'total': len(contracts),
+        'offset': offset,
+        'has_more': offset + limit < len(contracts)
+    })
 
 # Add these new routes
 
 @app.route('/reports')
 def reports():
-    conn = sqlite3.connect('reports.db')
-    conn.row_factory = sqlite3.Row
+    per_page = request.args.get('per_page', REPORTS_PAGE_SIZE, type=int)
+    per_page = max(1, min(per_page, REPORTS_MAX_PAGE_SIZE))
+    before_date = request.args.get('before_date')
+    before_id = request.args.get('before_id', type=int)
+    is_paged = bool(before_date and before_id is not None)
+    
+    # Paginação por chave (date, id): só busca a página pedida, sem o JSON dos relatórios
+    if is_paged:
+        page_filter = 'WHERE (date, id) < (?, ?)'
+        params = (before_date, before_id, per_page + 1)
+    else:
+        page_filter = ''
+        params = (per_page + 1,)
+    
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT * FROM reports ORDER BY date DESC')
+    c.execute(f'''
+        SELECT r.id, r.date, r.filename, r.row_set_id,
+               COUNT(t.id) AS technician_count,
+               COALESCE(SUM(t.os_count), 0) AS os_count,
+               COALESCE(SUM(t.total_value), 0) AS total_value
+        FROM (
+            SELECT id, date, filename, row_set_id FROM reports
+            {page_filter}
+            ORDER BY date DESC, id DESC
+            LIMIT ?
+        ) r
+        LEFT JOIN report_technician t ON t.report_id = r.id
+        GROUP BY r.id
+        ORDER BY r.date DESC, r.id DESC
+    ''', params)
     reports = c.fetchall()
-    conn.close()
-    return render_template_string(reports_template, reports=reports)
+    
+    next_cursor = None
+    if len(reports) > per_page:
+        reports = reports[:per_page]
+        next_cursor = {'date': reports[-1]['date'], 'id': reports[-1]['id']}
+    
+    return render_template('reports.html', 
+                                reports=reports,
+                                per_page=per_page,
+                                is_paged=is_paged,
+                                next_cursor=next_cursor)
 
 @app.route('/report/<int:report_id>')
 def view_report(report_id):
-    conn = sqlite3.connect('reports.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT * FROM reports WHERE id = ?', (report_id,))
-    report = c.fetchone()
-    conn.close()
     
-    if report: 
-        summary_data = json.loads(report['data'])
-        return render_template_string(html_template, 
-                                    summary_data=summary_data,
-                                    report_id=report_id)
-    return "Relatório não encontrado", 404
+    state = get_report_state(c, report_id)
+    if not state:
+        return "Relatório não encontrado", 404
+    
+    return conditional_response(report_id, state, 'report', lambda: render_template(
+        'index.html',
+        summary_data=load_summary_data(c, report_id, include_contracts=False),
+        report_id=report_id,
+        contracts_url=url_for('get_report_contracts', report_id=report_id)))
+
+@app.route('/report/<int:report_id>/contracts')
+def get_report_contracts(report_id):
+    technician, motivo, offset, limit = contracts_page_args()
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT id FROM report_motivo
+        WHERE report_id = ? AND technician_key = ? AND motivo = ?
+    ''', (report_id, technician.lower(), motivo))
+    motivo_ids = [row[0] for row in c.fetchall()]
+    placeholders = ','.join('?' * len(motivo_ids))
+    
+    contracts, total = [], 0
+    if motivo_ids:
+        c.execute(f'''
+            SELECT contract_id FROM report_contract
+            WHERE report_motivo_id IN ({placeholders})
+            ORDER BY report_motivo_id, position
+            LIMIT ? OFFSET ?
+        ''', (*motivo_ids, limit, offset))
+        contracts = [row[0] for row in c.fetchall()]
+        c.execute(f'''
+            SELECT COUNT(*) FROM report_contract WHERE report_motivo_id IN ({placeholders})
+        ''', motivo_ids)
+        total = c.fetchone()[0]
+    
+    return jsonify({
+        'contracts': contracts,
+        'total': total,
+        'offset': offset,
+        'has_more': offset + limit < total
+    })
 
 @app.route('/report/<int:report_id>/delete', methods=['POST'])
 def delete_report(report_id):
-    conn = sqlite3.connect('reports.db')
+    conn = get_db()
     c = conn.cursor()
+    # As tabelas report_* são apagadas em cascata (foreign_keys = ON)
+    c.execute('DELETE FROM removed_os WHERE report_id = ?', (report_id,))
     c.execute('DELETE FROM reports WHERE id = ?', (report_id,))
     conn.commit()
-    conn.close()
     return redirect(url_for('reports'))
 
 @app.route('/save_report', methods=['POST'])
 def save_report():
-    filename = request.form.get('filename')
-    report_data = request.form.get('report_data')
-    
-    if not filename or not report_data:
+    staging_token = request.form.get('staging_token')
+    if not staging_token:
         return "Dados inválidos", 400
     
-    conn = sqlite3.connect('reports.db')
+    staged = pop_staged_summary(staging_token)
+    if staged is None:
+        return "Resultado expirado ou já salvo. Envie o arquivo novamente.", 400
+    filename, summary_data = staged
+    
+    conn = get_db()
     c = conn.cursor()
+    # Versão das regras com que o job calculou este resultado e as OS de origem
     c.execute('''
-        INSERT INTO reports (date, filename, data)
-        VALUES (?, ?, ?)
+        SELECT j.rule_set_version, s.id FROM upload_jobs j
+        LEFT JOIN os_row_sets s ON s.id = j.row_set_id
+        WHERE j.staging_token = ?
+    ''', (staging_token,))
+    job = c.fetchone()
+    rule_set_version = job[0] if job and job[0] is not None else get_active_rule_set_version(conn)
+    row_set_id = job[1] if job else None
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    c.execute('''
+        INSERT INTO reports (date, updated_date, filename, data, rule_set_version, row_set_id)
+        VALUES (?, ?, ?, ?, ?, ?)
     ''', (
-        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        now,
+        now,
         filename,
-        report_data
+        '[]',  # O resumo fica só nas tabelas normalizadas
+        rule_set_version,
+        row_set_id
     ))
+    report_id = c.lastrowid
+    insert_summary_rows(c, report_id, summary_data)
+    rebuild_chart_aggregates(c, report_id)
     conn.commit()
-    conn.close()
     
     return redirect(url_for('reports'))
 
 @app.route('/report/<int:report_id>/chart')
 def view_chart(report_id):
-    conn = sqlite3.connect('reports.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT * FROM reports WHERE id = ?', (report_id,))
-    report = c.fetchone()
-    conn.close()
     
-    if report:
-        summary_data = json.loads(report['data'])
-        
-        # Aggregate OS types across all technicians
-        motivos_counter = Counter()
-        total_os = 0
-        
-        for tech in summary_data:
-            for motivo in tech['Motivos']:
-                motivos_counter[motivo['Motivo']] += motivo['Quantidade']
-                total_os += motivo['Quantidade']
-        
-        # Calculate percentages
-        chart_data = {
-            'labels': [],
-            'values': []
-        }
-        
-        for motivo, count in motivos_counter.most_common():
-            percentage = round((count / total_os) * 100, 1)
-            chart_data['labels'].append(motivo)
-            chart_data['values'].append(percentage)
-        
-        return render_template_string(chart_template, 
-                                    filename=report['filename'],
-                                    chart_data=chart_data)
+    state = get_report_state(c, report_id)
+    if not state:
+        return "Relatório não encontrado", 404
+    
+    return conditional_response(report_id, state, 'chart', lambda: render_template(
+        'chart.html',
+        filename=state['filename'],
+        chart_data=get_chart_data(c, report_id)))
+
+@app.route('/report/<int:report_id>/chart.json')
+def view_chart_json(report_id):
+    conn = get_db()
+    c = conn.cursor()
+    
+    state = get_report_state(c, report_id)
+    if not state:
+        return jsonify({'error': 'Relatório não encontrado'}), 404
+    
+    return conditional_response(report_id, state, 'chart-json', lambda: jsonify(
+        dict(get_chart_data(c, report_id), filename=state[0])))
+
+def touch_report(c, report_id):
+    """
+    Marca o relatório como alterado (nova versão e data de modificação)
+    """
+    c.execute('''
+        UPDATE reports SET version = version + 1, updated_date = ?
+        WHERE id = ?
+    ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), report_id))
+
+def remove_contract(c, report_id, contract_id, technician, motivo, removal_reason):
+    """
+    Retira um contrato da comissão: apaga a linha do contrato, decrementa os
+    contadores (e o valor que a OS rendia) e registra a remoção. Deve rodar dentro
+    de uma transação aberta com BEGIN IMMEDIATE. Retorna True se o contrato foi encontrado.
+    """
+    c.execute('''
+        SELECT rc.id, rm.id, rm.report_technician_id, rc.commission
+        FROM report_motivo rm
+        JOIN report_contract rc ON rc.report_motivo_id = rm.id
+        WHERE rm.report_id = ? AND rm.technician_key = ? AND rm.motivo = ? AND rc.contract_id = ?
+        ORDER BY rm.id, rc.position
+        LIMIT 1
+    ''', (report_id, technician.lower(), motivo, contract_id))
+    row = c.fetchone()
+    if not row:
+        return False
+    
+    contract_row_id, report_motivo_id, report_technician_id, commission = row
+    c.execute('DELETE FROM report_contract WHERE id = ?', (contract_row_id,))
+    if c.rowcount == 0:
+        return False
+    c.execute('UPDATE report_motivo SET quantity = quantity - 1 WHERE id = ?', (report_motivo_id,))
+    c.execute('''
+        UPDATE report_technician
+        SET os_count = os_count - 1, total_value = total_value - ?
+        WHERE id = ?
+    ''', (commission, report_technician_id))  # Adjust commission value
+    adjust_chart_total(c, report_id, motivo, -1)
+    touch_report(c, report_id)
+    
+    c.execute('''
+        INSERT INTO removed_os 
+        (report_id, contract_id, technician, motivo, removal_reason, removed_date, commission)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        report_id,
+        contract_id,
+        technician,
+        motivo,
+        removal_reason,
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        commission
+    ))
+    return True
+
+def restore_contract(c, report_id, contract_id, technician, motivo):
+    """
+    Devolve um contrato à comissão: insere a linha do contrato no fim da lista,
+    incrementa os contadores e apaga o registro de remoção. Deve rodar dentro de
+    uma transação aberta com BEGIN IMMEDIATE. Retorna True se algo foi restaurado;
+    sem registro de remoção nada é feito (o contrato não saiu deste relatório).
+    """
+    # A OS volta com o valor que rendia quando foi removida
+    c.execute('''
+        SELECT commission FROM removed_os
+        WHERE report_id = ? AND contract_id = ? AND technician = ? AND motivo = ?
+        ORDER BY id DESC LIMIT 1
+    ''', (report_id, contract_id, technician, motivo))
+    removed = c.fetchone()
+    if not removed:
+        return False
+    commission = removed[0]
     
-    return "Relatório não encontrado", 404
+    c.execute('''
+        SELECT rm.id, rm.report_technician_id
+        FROM report_motivo rm
+        WHERE rm.report_id = ? AND rm.technician_key = ? AND rm.motivo = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM report_contract rc
+              WHERE rc.report_motivo_id = rm.id AND rc.contract_id = ?
+          )
+    ''', (report_id, technician.lower(), motivo, contract_id))
+    
+    restored = False
+    for report_motivo_id, report_technician_id in c.fetchall():
+        c.execute('''
+            INSERT INTO report_contract (report_id, report_motivo_id, position, contract_id, commission)
+            VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM report_contract
+                           WHERE report_motivo_id = ?), ?, ?)
+        ''', (report_id, report_motivo_id, report_motivo_id, contract_id, commission))
+        c.execute('UPDATE report_motivo SET quantity = quantity + 1 WHERE id = ?', (report_motivo_id,))
+        c.execute('''
+            UPDATE report_technician
+            SET os_count = os_count + 1, total_value = total_value + ?
+            WHERE id = ?
+        ''', (commission, report_technician_id))  # Restore commission value
+        adjust_chart_total(c, report_id, motivo, 1)
+        touch_report(c, report_id)
+        
+        c.execute('''
+            DELETE FROM removed_os 
+            WHERE report_id = ? AND contract_id = ? AND technician = ? AND motivo = ?
+        ''', (report_id, contract_id, technician, motivo))
+        restored = True
+    return restored
+
+def get_technician_totals(c, report_id, technician_keys):
+    """
+    Retorna os totais atualizados (OS e valor) dos técnicos informados
+    """
+    placeholders = ','.join('?' * len(technician_keys))
+    c.execute(f'''
+        SELECT technician, os_count, total_value FROM report_technician
+        WHERE report_id = ? AND technician_key IN ({placeholders})
+        ORDER BY position
+    ''', (report_id, *technician_keys))
+    return [
+        {"Técnico": technician, "Quantidade de OS": os_count, "Valor Total": total_value}
+        for technician, os_count, total_value in c.fetchall()
+    ]
+
+def parse_batch_items(payload, fields):
+    """
+    Valida o corpo JSON das rotas em lote: {"report_id": ..., "items": [{...}, ...]}
+    """
+    if not isinstance(payload, dict) or not payload.get('report_id'):
+        return None, None
+    items = payload.get('items')
+    if not isinstance(items, list) or not items:
+        return None, None
+    for item in items:
+        if not isinstance(item, dict) or not all(item.get(field) for field in fields):
+            return None, None
+    return payload['report_id'], items
 
 @app.route('/remove_os', methods=['POST'])
 def remove_os():
@@ -1348,56 +3862,52 @@ def remove_os():
     motivo = request.form.get('motivo')
     removal_reason = request.form.get('removal_reason')
     
-    conn = sqlite3.connect('reports.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        # Get current report data
-        c.execute('SELECT data FROM reports WHERE id = ?', (report_id,))
-        report_data = json.loads(c.fetchone()[0])
-        
-        # Update report data
-        for tech in report_data:
-            if tech['Técnico'].lower() == technician.lower():
-                for m in tech['Motivos']:
-                    if m['Motivo'] == motivo:
-                        if contract_id in m['Contratos']:
-                            m['Contratos'].remove(contract_id)
-                            m['Quantidade'] -= 1
-                            tech['Quantidade de OS'] -= 1
-                            tech['Valor Total'] -= 3  # Adjust commission value
-                            
-                            # Add to removed_os table
-                            c.execute('''
-                                INSERT INTO removed_os 
-                                (report_id, contract_id, technician, motivo, removal_reason, removed_date)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                            ''', (
-                                report_id,
-                                contract_id,
-                                technician,
-                                motivo,
-                                removal_reason,
-                                datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            ))
-        
-        # Update report data in database
-        c.execute('UPDATE reports SET data = ? WHERE id = ?',
-                 (json.dumps(report_data), report_id))
-        
+        c.execute('BEGIN IMMEDIATE')
+        remove_contract(c, report_id, contract_id, technician, motivo, removal_reason)
         conn.commit()
         return jsonify({'success': True})
     
     except Exception as e:
         conn.rollback()
         return jsonify({'success': False, 'error': str(e)})
-    finally:
-        conn.close()
+
+@app.route('/remove_os/batch', methods=['POST'])
+def remove_os_batch():
+    report_id, items = parse_batch_items(
+        request.get_json(silent=True),
+        ('contract_id', 'technician', 'motivo', 'removal_reason')
+    )
+    if items is None:
+        return jsonify({'success': False, 'error': 'Dados inválidos'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        # Todas as remoções na mesma transação: ou todas entram, ou nenhuma
+        c.execute('BEGIN IMMEDIATE')
+        applied = [
+            remove_contract(c, report_id, str(item['contract_id']), item['technician'],
+                            item['motivo'], item['removal_reason'])
+            for item in items
+        ]
+        technicians = get_technician_totals(
+            c, report_id, sorted({item['technician'].lower() for item in items})
+        )
+        conn.commit()
+        return jsonify({'success': True, 'applied': applied, 'technicians': technicians})
+    
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/get_removed_os/<int:report_id>')
 def get_removed_os(report_id):
-    conn = sqlite3.connect('reports.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
     c.execute('''
@@ -1407,36 +3917,41 @@ def get_removed_os(report_id):
     ''', (report_id,))
     
     removed = [dict(row) for row in c.fetchall()]
-    conn.close()
+    
+    # ?grouped=1 devolve {técnico (minúsculo): {motivo: [OS removidas]}}
+    if request.args.get('grouped'):
+        grouped = {}
+        for row in removed:
+            grouped.setdefault(row['technician'].lower(), {}).setdefault(row['motivo'], []).append(row)
+        return jsonify(grouped)
     
     return jsonify(removed)
 
 @app.route('/report/<int:report_id>/removed_os')
 def view_removed_os(report_id):
-    conn = sqlite3.connect('reports.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
     # Get report information
-    c.execute('SELECT filename FROM reports WHERE id = ?', (report_id,))
-    report = c.fetchone()
-    
-    # Get all removed OS for this report
-    c.execute('''
-        SELECT * FROM removed_os 
-        WHERE report_id = ? 
-        ORDER BY removed_date DESC
-    ''', (report_id,))
-    
-    removed_os = [dict(row) for row in c.fetchall()]
-    conn.close()
+    state = get_report_state(c, report_id)
+    if not state:
+        return "Relatório não encontrado", 404
     
-    if report:
-        return render_template_string(removed_os_template, 
-                                    filename=report['filename'],
+    def render():
+        # Get all removed OS for this report
+        c.execute('''
+            SELECT * FROM removed_os 
+            WHERE report_id = ? 
+            ORDER BY removed_date DESC
+        ''', (report_id,))
+        removed_os = [dict(row) for row in c.fetchall()]
+        
+        return render_template('removed_os.html', 
+                                    filename=state['filename'],
                                     removed_os=removed_os,
-                                    report_id=report_id)  # Add report_id here
-    return "Relatório não encontrado", 404
+                                    report_id=report_id)
+    
+    return conditional_response(report_id, state, 'removed-os', render)
 
 # Add this new route
 @app.route('/restore_os', methods=['POST'])
@@ -1446,44 +3961,50 @@ def restore_os():
     technician = request.form.get('technician')
     motivo = request.form.get('motivo')
     
-    conn = sqlite3.connect('reports.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        # Get current report data
-        c.execute('SELECT data FROM reports WHERE id = ?', (report_id,))
-        report_data = json.loads(c.fetchone()[0])
-        
-        # Update report data
-        for tech in report_data:
-            if tech['Técnico'].lower() == technician.lower():
-                for m in tech['Motivos']:
-                    if m['Motivo'] == motivo:
-                        if contract_id not in m['Contratos']:
-                            m['Contratos'].append(contract_id)
-                            m['Quantidade'] += 1
-                            tech['Quantidade de OS'] += 1
-                            tech['Valor Total'] += 3  # Restore commission value
-                            
-                            # Remove from removed_os table
-                            c.execute('''
-                                DELETE FROM removed_os 
-                                WHERE report_id = ? AND contract_id = ? AND technician = ? AND motivo = ?
-                            ''', (report_id, contract_id, technician, motivo))
-        
-        # Update report data in database
-        c.execute('UPDATE reports SET data = ? WHERE id = ?',
-                 (json.dumps(report_data), report_id))
-        
+        c.execute('BEGIN IMMEDIATE')
+        restore_contract(c, report_id, contract_id, technician, motivo)
         conn.commit()
         return jsonify({'success': True})
     
     except Exception as e:
         conn.rollback()
         return jsonify({'success': False, 'error': str(e)})
-    finally:
-        conn.close()
+
+@app.route('/restore_os/batch', methods=['POST'])
+def restore_os_batch():
+    report_id, items = parse_batch_items(
+        request.get_json(silent=True),
+        ('contract_id', 'technician', 'motivo')
+    )
+    if items is None:
+        return jsonify({'success': False, 'error': 'Dados inválidos'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        applied = [
+            restore_contract(c, report_id, str(item['contract_id']), item['technician'], item['motivo'])
+            for item in items
+        ]
+        technicians = get_technician_totals(
+            c, report_id, sorted({item['technician'].lower() for item in items})
+        )
+        conn.commit()
+        return jsonify({'success': True, 'applied': applied, 'technicians': technicians})
+    
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)})
 
 if __name__ == '__main__':
     init_db()
+    with app.app_context():
+        sync_technician_index(get_db())
+    compile_templates()
     app.run(host='0.0.0.0', port=5000, debug=True)